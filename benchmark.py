@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Benchmark della pipeline di riduzione Schmidt.
+
+Genera una notte sintetica (bias, dark a più tempi di esposizione, flat e
+oggetti in più filtri, con la non linearità del CCD nuovo iniettata) e misura
+le singole fasi di reduction_1.0.py: tempo, frame/s, MB/s e picco di memoria
+(RSS). Ogni fase gira in un processo separato, così il picco di memoria è
+quello della fase e non di tutto il benchmark.
+I risultati vengono salvati in JSON per confrontare versioni diverse.
+
+Uso:
+    python benchmark.py --dir /tmp/notte --output risultati.json
+    python benchmark.py --dir /tmp/notte --nx 1024 --ny 1024 --confronta vecchi.json
+
+Le fasi che richiedono IRAF vengono segnate come non disponibili, senza
+lanciarle, se PyRAF non è installato.
+Le fasi lavorano in una copia della notte (link simbolici ai frame), così
+nella cartella dei frame grezzi non viene scritto niente.
+'''
+
+import argparse
+import imp
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+
+import numpy as np
+from astropy.io import fits
+
+PIPELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reduction_1.0.py')
+
+############################## NOTTE #####################################
+
+'''
+Inverte la correzione di linearizzazione: dato il segnale vero restituisce
+quello misurato da un CCD con coefficienti co1, co2, co3, cioè x tale che
+x * (co1 + co2*x/32767 + co3*(x/32767)**2) = vero. Metodo di Newton.
+'''
+def non_linearizza(vero, co1 = 1., co2 = -0.10140076, co3 = 0.034650755):
+    x = vero.copy()
+    for i in range(6):
+        u = x/32767.
+        f = x*(co1+co2*u+co3*u*u)-vero
+        df = co1+2*co2*u+3*co3*u*u
+        x -= f/df
+    return x
+
+'''
+Genera una notte sintetica nella cartella out_dir.
+Input:
+    - out_dir = cartella di output (viene creata)
+    - nx, ny = dimensioni dei frame, default = 4096x4096
+    - n_bias = numero di bias
+    - dark_exptime = tempi di esposizione dei dark
+    - n_dark = numero di dark per tempo di esposizione
+    - filtri = filtri dei flat e degli oggetti
+    - n_flat, n_obj = flat e oggetti per filtro
+    - seed = seme per i numeri casuali
+Output:
+    - lista dei file creati
+'''
+def genera_notte(out_dir, nx = 4096, ny = 4096, n_bias = 10, dark_exptime = (30., 60., 120.), n_dark = 5, \
+        filtri = ('B', 'V', 'R'), n_flat = 5, n_obj = 10, seed = 1):
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    rng = np.random.RandomState(seed)
+    livello_bias = 1000.+rng.normal(0, 2., (ny, nx))
+    y, x = np.mgrid[0:ny, 0:nx]
+    vignettatura = 1.-0.2*(((x-nx/2.)/nx)**2+((y-ny/2.)/ny)**2)
+    pixel = rng.normal(1., 0.01, (ny, nx))
+
+    frames = []
+    def scrivi(tipo, oggetto, filtro, exptime, vero):
+        n = len(frames)+1
+        nome = os.path.join(out_dir, 'sch%04d.fits' % n)
+        misurato = livello_bias+non_linearizza(np.clip(vero, 0, None))+rng.normal(0, 8., (ny, nx))
+        h = fits.Header()
+        h['OBJECT'] = oggetto
+        h['IMAGETYP'] = tipo
+        h['FILTER'] = filtro
+        h['EXPTIME'] = float(exptime)
+        h['AIRMASS'] = round(1.+0.5*rng.rand(), 3)
+        h['DATE-OBS'] = '2017-01-12T%02i:%02i:%02i' % (20+n//3600 % 4, n//60 % 60, n % 60)
+        h['XBINNING'] = 1
+        h['YBINNING'] = 1
+        fits.writeto(nome, np.clip(misurato, 0, 65535).astype(np.uint16), h, overwrite=True)
+        frames.append(nome)
+
+    for i in range(n_bias):
+        scrivi('Bias', 'bias', 'C', 0., np.zeros((ny, nx)))
+    for t in dark_exptime:
+        for i in range(n_dark):
+            scrivi('Dark', 'dark', 'C', t, rng.poisson(0.5*t, (ny, nx)).astype(float))
+    for filtro in filtri:
+        for i in range(n_flat):
+            scrivi('Flat', 'flat', filtro, 2., 20000.*vignettatura*pixel*rng.uniform(0.7, 1.3))
+    for filtro in filtri:
+        for i in range(n_obj):
+            t = dark_exptime[i % len(dark_exptime)]
+            cielo = 5.*t*vignettatura*pixel
+            stelle = np.zeros((ny, nx))
+            sx = rng.randint(0, nx, 200)
+            sy = rng.randint(0, ny, 200)
+            stelle[sy, sx] = rng.uniform(1000, 20000, 200)
+            scrivi('Object', 'campo%i' % (i % 3), filtro, t, cielo+stelle)
+    return frames
+
+############################## MISURA ####################################
+
+'''
+Esegue una fase in un processo separato e ne misura tempo, tempo di CPU
+e picco di memoria. funzione(*args) deve restituire (frame, byte) processati.
+'''
+def misura(nome, funzione, args):
+    coda = multiprocessing.Queue()
+
+    def figlio():
+        try:
+            t0, c0 = time.time(), os.times()
+            frame, nbyte = funzione(*args)
+            t1, c1 = time.time(), os.times()
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.     #KB su linux
+            coda.put({'fase': nome, 'secondi': t1-t0, 'cpu': (c1[0]-c0[0])+(c1[1]-c0[1]), \
+                    'frame': frame, 'MB': nbyte/1024.**2, 'frame_s': frame/(t1-t0), \
+                    'MB_s': nbyte/1024.**2/(t1-t0), 'rss_MB': rss})
+        except Exception:
+            coda.put({'fase': nome, 'errore': traceback.format_exc().strip().splitlines()[-1]})
+
+    p = multiprocessing.Process(target=figlio)
+    p.start()
+    risultato = coda.get()
+    p.join()
+    return risultato
+
+def modulo():
+    return imp.load_source('reduction', PIPELINE)
+
+def pyraf_installato():
+    try:
+        imp.find_module('pyraf')
+        return True
+    except ImportError:
+        return False
+
+'''
+Crea la cartella di lavoro con un link simbolico per ogni frame della notte.
+'''
+def copia(notte, lavoro):
+    if os.path.isdir(lavoro):
+        shutil.rmtree(lavoro)
+    os.makedirs(lavoro)
+    files = sorted(notte+item for item in os.listdir(notte) if item.endswith('.fits'))
+    for item in files:
+        os.symlink(item, lavoro+os.path.basename(item))
+    return files
+
+def byte(files):
+    return sum([os.path.getsize(item) for item in files])
+
+def tipo(notte, tipo_frame):
+    r = modulo()
+    obs = r.Tabella(r.hsel(notte+'*.fits', main_dir=notte))
+    return [notte+item+'.fits' for item in obs.group_by(type = tipo_frame)]
+
+############################## FASI ######################################
+
+def fase_hsel(notte):
+    r = modulo()
+    cache = notte+'bench_catalogo.json'
+    if os.path.exists(cache):
+        os.remove(cache)
+    files = r.espandi(notte+'*.fits')
+    r.hsel(notte+'*.fits', main_dir=notte, cache=cache)
+    return len(files), 2880*len(files)
+
+def fase_hsel_cache(notte):
+    r = modulo()
+    files = r.espandi(notte+'*.fits')
+    r.hsel(notte+'*.fits', main_dir=notte, cache=notte+'bench_catalogo.json')
+    return len(files), 0
+
+def fase_organizza(notte, lavoro):
+    r = modulo()
+    copia(notte, lavoro)
+    obs = r.Tabella(r.hsel(lavoro+'*.fits', main_dir=lavoro))
+    r.organizza(obs, lavoro)
+    return len(obs), 0
+
+def fase_trim(notte, section, engine):
+    r = modulo()
+    bias = tipo(notte, 'Bias')
+    lista = [os.path.basename(item)[:-5] for item in bias]
+    r.trim(lista, notte, section = section, engine = engine)
+    return len(lista), byte(bias)
+
+def fase_combine(notte, section, engine):
+    r = modulo()
+    bias = tipo(notte, 'Bias')
+    lista = [os.path.basename(item)[:-5] for item in bias]
+    r.combine(lista, '', 'bench_mbias.fits', notte, engine = engine, section = section)
+    return len(lista), byte(bias)
+
+def fase_linearize(notte, engine):
+    r = modulo()
+    flat = tipo(notte, 'Flat')
+    for item in flat:
+        r.linearize(item, item[:-5]+'.bench_l', engine = engine)
+    return len(flat), byte(flat)
+
+def fase_linearizza_array(notte, lincor):
+    r = modulo()
+    flat = tipo(notte, 'Flat')
+    for item in flat:
+        r.linearizza_array(r.carica(item)[0], lincor = lincor)
+    return len(flat), byte(flat)
+
+def fase_operation(notte, engine):
+    r = modulo()
+    flat = tipo(notte, 'Flat')
+    for item in flat:
+        r.operation(item, 1000., '-', item[:-5]+'.bench_b', engine = engine)
+    return len(flat), byte(flat)
+
+def fase_stats(notte, engine):
+    r = modulo()
+    flat = tipo(notte, 'Flat')
+    r.stats([os.path.basename(item)[:-5] for item in flat], '', notte, engine = engine)
+    return len(flat), byte(flat)
+
+def fase_mediana(notte):
+    r = modulo()
+    flat = tipo(notte, 'Flat')
+    for item in flat:
+        hdul = fits.open(item, memmap=True, do_not_scale_image_data=True)
+        h = hdul[0].header
+        r.mediana(hdul[0].data, h.get('BSCALE', 1.), h.get('BZERO', 0.))
+        hdul.close()
+    return len(flat), byte(flat)
+
+def fase_pipeline(notte, lavoro, section, engine, workers):
+    r = modulo()
+    files = copia(notte, lavoro)
+    r.pipeline(lavoro, section, engine = engine, workers = workers, interattivo = False, display = False)
+    return len(files), byte(files)
+
+def pulisci(notte):
+    for item in os.listdir(notte):
+        if item.endswith('.fits') and ('.bench' in item or item.endswith('.tr.fits') or item.startswith('bench_')):
+            os.remove(notte+item)
+
+############################## VERIFICA ##################################
+
+'''
+Controlla che i formati di SCRIVI_FITS si rileggano con CARICA come
+promesso, prima di misurarne i tempi:
+    - 'uint16' restituisce esattamente tutti i valori da 0 a 65535
+    - 'int16' sbaglia al più di mezzo BSCALE
+    - 'gzip' restituisce esattamente il float
+Output:
+    - lista degli errori, vuota se va tutto bene
+'''
+def verifica_formati(cartella):
+    r = modulo()
+    nome = cartella+'bench_formato.fits'
+    errori = []
+    interi = np.arange(65536, dtype=np.float32).reshape(256, 256)
+    reali = np.random.RandomState(0).normal(1000., 30., (256, 256)).astype(np.float32)
+    for formato, data, tolleranza in (('uint16', interi, 0.), ('int16', reali, (reali.max()-reali.min())/131068.), \
+            ('gzip', reali, 0.)):
+        r.scrivi_fits(nome, data, formato = formato)
+        letti = r.carica(nome)[0]
+        scarto = np.abs(letti.astype(np.float64)-data).max()
+        if scarto > tolleranza*(1.+1e-6):
+            errori.append('%s: scarto %g > %g' % (formato, scarto, tolleranza))
+    os.remove(nome)
+    return errori
+
+############################## MAIN ######################################
+
+def versione():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], \
+                cwd=os.path.dirname(PIPELINE)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'sconosciuta'
+
+def confronta(risultati, vecchi_file):
+    f = open(vecchi_file)
+    vecchi = dict((item['fase'], item) for item in json.load(f)['risultati'])
+    f.close()
+    print '%-24s %10s %10s %8s' % ('fase', 'prima [s]', 'ora [s]', 'rapporto')
+    for item in risultati:
+        prima = vecchi.get(item['fase'], {})
+        if 'secondi' in item and 'secondi' in prima:
+            print '%-24s %10.2f %10.2f %8.2f' % (item['fase'], prima['secondi'], item['secondi'], \
+                    item['secondi']/prima['secondi'])
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Benchmark della pipeline Schmidt su una notte sintetica')
+    parser.add_argument('--dir', default = './benchmark_notte/', help = 'cartella della notte sintetica')
+    parser.add_argument('--nx', type = int, default = 4096)
+    parser.add_argument('--ny', type = int, default = 4096)
+    parser.add_argument('--bias', type = int, default = 10)
+    parser.add_argument('--dark', type = int, default = 5, help = 'dark per tempo di esposizione')
+    parser.add_argument('--dark-exptime', default = '30,60,120')
+    parser.add_argument('--flat', type = int, default = 5, help = 'flat per filtro')
+    parser.add_argument('--obj', type = int, default = 10, help = 'oggetti per filtro')
+    parser.add_argument('--filtri', default = 'B,V,R')
+    parser.add_argument('--section', default = None, help = 'sezione di trimming, default = bordo di 100 pixel')
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--rigenera', action = 'store_true', help = 'rigenera la notte anche se esiste')
+    parser.add_argument('--output', default = 'benchmark.json')
+    parser.add_argument('--confronta', default = None, help = 'JSON di un benchmark precedente')
+    args = parser.parse_args(argv)
+
+    notte = os.path.abspath(args.dir)+'/'
+    copia_notte = notte.rstrip('/')+'_copia/'                                 #fasi sui singoli task
+    lavoro = notte.rstrip('/')+'_lavoro/'                                   #organizza e pipeline
+    section = args.section or '[%i:%i,%i:%i]' % (101, args.nx-100, 101, args.ny-100)
+    exptime = [float(item) for item in args.dark_exptime.split(',')]
+    filtri = args.filtri.split(',')
+
+    if args.rigenera or not os.path.isdir(notte) or not [item for item in os.listdir(notte) if item.endswith('.fits')]:
+        print 'Genero la notte sintetica in %s' % notte
+        t0 = time.time()
+        genera_notte(notte, args.nx, args.ny, args.bias, exptime, args.dark, filtri, args.flat, args.obj)
+        print '... %.1f s' % (time.time()-t0)
+    copia(notte, copia_notte)
+    errori = verifica_formati(copia_notte)
+    if errori:
+        print 'Formati di scrittura non validi: %s' % '; '.join(errori)
+        return 1
+
+    fasi = [
+        ('hsel', fase_hsel, (copia_notte,)),
+        ('hsel_cache', fase_hsel_cache, (copia_notte,)),
+        ('organizza', fase_organizza, (notte, lavoro)),
+        ('trim_iraf', fase_trim, (copia_notte, section, 'iraf')),
+        ('trim_numpy', fase_trim, (copia_notte, section, 'numpy')),
+        ('combine_iraf', fase_combine, (copia_notte, section, 'iraf')),
+        ('combine_numpy', fase_combine, (copia_notte, section, 'numpy')),
+        ('linearize_iraf', fase_linearize, (copia_notte, 'iraf')),
+        ('linearize_numpy', fase_linearize, (copia_notte, 'numpy')),
+        ('linearizza_polinomio', fase_linearizza_array, (copia_notte, 'polinomio')),
+        ('linearizza_tabella', fase_linearizza_array, (copia_notte, 'tabella')),
+        ('operation_iraf', fase_operation, (copia_notte, 'iraf')),
+        ('operation_numpy', fase_operation, (copia_notte, 'numpy')),
+        ('stats_iraf', fase_stats, (copia_notte, 'iraf')),
+        ('stats_numpy', fase_stats, (copia_notte, 'numpy')),
+        ('mediana', fase_mediana, (copia_notte,)),
+        ('pipeline_iraf', fase_pipeline, (notte, lavoro, section, 'iraf', args.workers)),
+        ('pipeline_numpy', fase_pipeline, (notte, lavoro, section, 'numpy', args.workers)),
+    ]
+    iraf = pyraf_installato()
+    risultati = []
+    for nome, funzione, fargs in fasi:
+        if not iraf and 'iraf' in fargs:
+            risultato = {'fase': nome, 'errore': 'PyRAF non installato'}
+        else:
+            risultato = misura(nome, funzione, fargs)
+        risultati.append(risultato)
+        if 'errore' in risultato:
+            print '%-24s non disponibile: %s' % (nome, risultato['errore'])
+        else:
+            print '%-24s %8.2f s %8.2f frame/s %8.1f MB/s %8.0f MB RSS' % (nome, risultato['secondi'], \
+                    risultato['frame_s'], risultato['MB_s'], risultato['rss_MB'])
+        pulisci(copia_notte)
+
+    parametri = dict(vars(args))
+    parametri['section'] = section
+    f = open(args.output, 'w')
+    json.dump({'versione': versione(), 'data': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': os.uname()[1], \
+            'cpu': multiprocessing.cpu_count(), 'parametri': parametri, 'risultati': risultati}, f, indent=1)
+    f.close()
+    print 'Risultati in %s' % args.output
+
+    if args.confronta:
+        confronta(risultati, args.confronta)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
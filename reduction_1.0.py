@@ -17,22 +17,265 @@ Ogni funzione ha un header che spiega in maggior dettaglio il suo funzionamento.
 
 
 import numpy as np
-from pyraf import iraf
+from astropy.io import fits
+import argparse
+import bisect
+import datetime
+import errno
+import glob
+import hashlib
+import imp
+import inspect
+import json
+import multiprocessing
 import os
+import Queue
+import shutil
+import struct
 import sys
+import tempfile
+import threading
+import time
+import traceback
+import zlib
 
-iraf.noao(_doprint=0)
-iraf.imred(_doprint=0)
-iraf.irred(_doprint=0)
 
+############################# ANTEPRIMA ###############################
+'''
+Anteprime PNG delle immagini, al posto di iraf.display su DS9: non serve
+un display e la pipeline non si ferma ad aspettarlo.
+L'immagine viene ridotta a blocchi (media) fino a lato pixel al massimo,
+scalata tra i limiti di ZSCALE e scritta in PNG a 8 bit in scala di grigi,
+con il nord (riga 1 del FITS) in basso come su DS9.
+Input:
+    - data = array dell'immagine
+    - nome = file PNG
+    - lato = lato massimo dell'anteprima in pixel, default = 512
+'''
+def anteprima(data, nome, lato = 512):
+    fattore = int(np.ceil(max(data.shape)/float(lato)))
+    piccola = riduci_blocchi(data, fattore)
+    z1, z2 = zscale(piccola)
+    scala = 255./(z2-z1) if z2 > z1 else 0.
+    grigi = np.clip((np.nan_to_num(piccola)-z1)*scala, 0, 255).astype(np.uint8)
+    scrivi_png(nome, grigi[::-1])
+
+'''
+Media a blocchi di fattore x fattore pixel (i bordi che avanzano sono scartati).
+'''
+def riduci_blocchi(data, fattore):
+    if fattore <= 1:
+        return np.asarray(data, dtype=np.float32)
+    ny, nx = data.shape[0]//fattore, data.shape[1]//fattore
+    blocchi = np.asarray(data[:ny*fattore, :nx*fattore], dtype=np.float32).reshape(ny, fattore, nx, fattore)
+    return blocchi.mean(axis=3).mean(axis=1)
+
+'''
+Limiti di visualizzazione con l'algoritmo zscale di IRAF/DS9: su un
+campione di pixel ordinati si adatta una retta con reiezione iterativa dei
+punti lontani, e i limiti sono la mediana -/+ la pendenza divisa per il
+contrasto, entro il minimo e il massimo del campione.
+Input:
+    - data = array dell'immagine
+    - campioni = numero di pixel del campione, default = 1000
+    - contrasto = default = 0.25, come DS9
+Output:
+    - z1, z2 = limiti
+'''
+def zscale(data, campioni = 1000, contrasto = 0.25, sigma = 2.5, iterazioni = 5):
+    passo = max(1, int(np.sqrt(data.size/float(campioni))))
+    campione = np.asarray(data[::passo, ::passo], dtype=np.float64).ravel()
+    campione = np.sort(campione[np.isfinite(campione)])
+    n = len(campione)
+    if n == 0:
+        return 0., 1.
+    z1, z2 = campione[0], campione[-1]
+    centro = n//2
+    mediana = campione[centro] if n % 2 else 0.5*(campione[centro-1]+campione[centro])
+    x = np.arange(n, dtype=np.float64)
+    buoni = np.ones(n, dtype=bool)
+    pendenza = 0.
+    for i in range(iterazioni):
+        if buoni.sum() < max(5, n//2):                              #troppi punti rifiutati, tengo l'ultima retta
+            break
+        pendenza, intercetta = np.polyfit(x[buoni], campione[buoni], 1)
+        residui = campione-(intercetta+pendenza*x)
+        soglia = sigma*residui[buoni].std()
+        nuovi = np.abs(residui) < soglia
+        if soglia == 0 or (nuovi == buoni).all():
+            break
+        buoni = nuovi
+    if contrasto > 0:
+        pendenza /= contrasto
+    return max(z1, mediana-(centro-1)*pendenza), min(z2, mediana+(n-centro)*pendenza)
+
+'''
+Scrive un PNG a 8 bit in scala di grigi usando solo zlib.
+'''
+def scrivi_png(nome, grigi):
+    ny, nx = grigi.shape
+    righe = np.zeros((ny, nx+1), dtype=np.uint8)                     #ogni riga inizia con il filtro 0
+    righe[:, 1:] = grigi
+    def blocco(tipo, dati):
+        return struct.pack('>I', len(dati))+tipo+dati+struct.pack('>I', zlib.crc32(tipo+dati) & 0xffffffff)
+    f = open(nome, 'wb')
+    f.write('\x89PNG\r\n\x1a\n')
+    f.write(blocco('IHDR', struct.pack('>IIBBBBB', nx, ny, 8, 0, 0, 0, 0)))
+    f.write(blocco('IDAT', zlib.compress(righe.tostring(), 6)))
+    f.write(blocco('IEND', ''))
+    f.close()
+
+'''
+ANTEPRIME: anteprime di una notte scritte in un thread in background, e
+indice HTML (index.html nella cartella delle anteprime) con tutte le
+anteprime della cartella, anche quelle scritte da altri processi.
+AGGIUNGI mette in coda un'immagine (array o nome del file), CHIUDI aspetta
+le anteprime in coda e scrive l'indice.
+'''
+class Anteprime(object):
+
+    def __init__(self, cartella, titolo = '', lato = 512):
+        self.cartella = os.path.join(cartella, '')
+        self.titolo = titolo
+        self.lato = lato
+        if not os.path.isdir(self.cartella):
+            os.makedirs(self.cartella)
+        self.coda = Queue.Queue()
+        self.thread = threading.Thread(target = self.lavora)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def aggiungi(self, immagine, nome):
+        self.coda.put((immagine, self.cartella+nome+'.png'))
+
+    def lavora(self):
+        while True:
+            item = self.coda.get()
+            if item is None:
+                return
+            immagine, nome = item
+            try:
+                if isinstance(immagine, basestring):
+                    immagine = carica(immagine)[0]
+                anteprima(immagine, nome, self.lato)
+            except Exception as e:                                  #un'anteprima non ferma la riduzione
+                print 'Anteprima %s non riuscita: %s' % (nome, e)
+
+    def chiudi(self):
+        self.coda.put(None)
+        self.thread.join()
+        indice_anteprime(self.cartella, self.titolo)
+
+'''
+Scrive index.html con le anteprime PNG di una cartella.
+'''
+def indice_anteprime(cartella, titolo = ''):
+    nomi = sorted(item for item in os.listdir(cartella) if item.endswith('.png'))
+    f = open(os.path.join(cartella, 'index.html'), 'w')
+    print >>f, '<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>%s</title>' % titolo
+    print >>f, '<style>body{font-family:sans-serif;background:#222;color:#ddd} figure{display:inline-block;margin:4px}' \
+            ' img{width:256px;image-rendering:pixelated}</style></head><body>'
+    print >>f, '<h1>%s</h1><p>%i immagini, %s</p>' % (titolo, len(nomi), time.strftime('%Y-%m-%d %H:%M'))
+    for item in nomi:
+        print >>f, '<figure><a href="%s"><img src="%s" loading="lazy"></a><figcaption>%s</figcaption></figure>' \
+                % (item, item, item[:-len('.png')])
+    print >>f, '</body></html>'
+    f.close()
+
+############################# CALIBRA ###############################
+
+'''
+Calibrazione completa di un frame in memoria, in un solo passaggio:
+taglio, correzione per bias, linearizzazione, correzione per dark e per flat.
+Il frame grezzo viene letto una sola volta e viene scritto solo il file finale,
+senza i file intermedi .tr, .b, .l e .d.
+I master devono essere gia' caricati in memoria (vedi CARICA) e avere le
+dimensioni della sezione di trimming.
+
+Input:
+    - inp = nome dell'immagine grezza
+    - out = nome del file di output (tipicamente *.f.fits)
+    - section = sezione dell'immagine per il trimming
+    - mbias = array del masterbias
+    - mdark = array del master dark, default = None (nessuna correzione)
+    - mflat = array del masterflat, default = None (nessuna correzione)
+    - co1, ..., co3 = coefficienti per la linearizzazione
+    - lincor = 'polinomio' o 'tabella', vedi LINEARIZZA_ARRAY
+    - dati = (data, header) della sezione già letta (vedi FLUSSO), default = None
+    - scrittore = SCRITTORE a cui passare il risultato, default = None (scrive subito)
+    - formato = formato del file di output, vedi SCRIVI_FITS, default = 'float32'
+    - png = file dell'ANTEPRIMA del risultato, default = None (nessuna)
+    - debug = stampa output aggiuntivi, default = False
+'''
+
+def calibra(inp, out, section, mbias, mdark = None, mflat = None, co1 = 1., co2 = -0.10140076, co3 = 0.034650755, \
+        lincor = 'polinomio', dati = None, scrittore = None, formato = 'float32', png = None, debug = False):
+    if dati is None:
+        dati = carica(inp, section)
+    data, header = dati
+    data -= mbias
+    linearizza_array(data, co1, co2, co3, lincor = lincor)
+    if mdark is not None:
+        data -= mdark
+    if mflat is not None:
+        data /= mflat
+    header.add_history('calibra: trim %s, bias, lincor [%g,%g,%g], dark %s, flat %s' \
+            % (section, co1, co2, co3, mdark is not None, mflat is not None))
+    if debug:
+        print '%s -> %s' % (inp, out)
+    if scrittore is not None:
+        scrittore.scrivi(out, data, header, formato, png)
+        return
+    scrivi_fits(out, data, header, formato)
+    if png is not None:
+        anteprima(data, png)
+
+############################# CARICA ###############################
+
+'''
+Legge un'immagine FITS in memoria come array float32 (come le immagini
+real di IRAF), eventualmente solo nella sezione richiesta.
+
+Input:
+    - nome = nome dell'immagine, con o senza estensione .fits
+    - section = sezione in formato IRAF, default = None (immagine intera)
+    - memmap = legge con memmap (solo le righe della sezione); False legge
+      tutto il file in blocco, default = True
+    - debug = non utilizzato
+Output
+    - data = array con i pixel
+    - header = header primario dell'immagine
+'''
+
+def carica(nome, section = None, memmap = True, debug = False):
+    hdul = fits.open(nome_fits(nome), memmap=memmap, do_not_scale_image_data=True)   #BZERO/BSCALE applicati a mano
+    hdu = immagine(hdul)
+    header = hdu.header.copy()
+    data = hdu.data
+    if section is not None:
+        data = data[sezione(section)]
+        sposta_header(header, section)
+    blank = header.pop('BLANK', None)
+    vuoti = data == blank if blank is not None else None
+    data = np.array(data, dtype=np.float32)
+    hdul.close()
+    bscale = header.pop('BSCALE', 1.)
+    bzero = header.pop('BZERO', 0.)
+    if bscale != 1.:
+        data *= bscale
+    if bzero != 0.:
+        data += bzero
+    if vuoti is not None:
+        data[vuoti] = np.nan
+    return data, header
 
 ############################ CARTELLE ##############################
 
 '''
 Crea cartelle per ordinare i file in base al tipo e al filtro.
-Se il file org.log viene trovato nella directory le subdirectory non vengono create.
+Le cartelle già esistenti non vengono toccate.
 Input:
-    - Tabella = tabella con le informazioni che esce da HSEL
+    - Tabella = tabella delle osservazioni (vedi TABELLA)
     - main_dir = directory di lavoro, default = ./
     - debug = opzione per avere output aggiuntivi
 Output
@@ -51,29 +294,379 @@ def cartelle(tabella, main_dir = './', debug=False):
     
     bias_dir = main_dir+'bias/'
     dark_dir = main_dir+'dark/'
-    if not os.path.exists(main_dir+'org.log'):
-        os.system('mkdir '+bias_dir)                         #creo cartella bias
-        os.system('mkdir '+dark_dir)                         #creo cartella dark
-
-    filtri =[]                                               #individuo i filtri usati
-    for item in tabella['filter']:
-        if item not in filtri:
-            filtri.append(item)
+    if not os.path.isdir(bias_dir):
+        os.makedirs(bias_dir)                                #creo cartella bias
+    if not os.path.isdir(dark_dir):
+        os.makedirs(dark_dir)                                #creo cartella dark
+
+    filtri = tabella.valori('filter')                        #individuo i filtri usati
     if debug:
         print filtri
-    if not os.path.exists(main_dir+'org.log'):
-        for item in filtri:
-            os.system('mkdir '+main_dir+item)                #creo sottocartelle per filti, oggetti e flats
-            os.system('mkdir '+main_dir+item+'/objects')
-            os.system('mkdir '+main_dir+item+'/flats')
+    for item in filtri:
+        for sub in ['/objects', '/flats']:                   #creo sottocartelle per filti, oggetti e flats
+            if not os.path.isdir(main_dir+item+sub):
+                os.makedirs(main_dir+item+sub)
     return filtri, bias_dir, dark_dir
 
+############################# CATALOGO ###############################
+
+'''
+Catalogo degli header FITS, salvato su disco in formato JSON.
+Per ogni file tiene path assoluto, dimensione, mtime e le keyword
+dell'header primario. Un file viene riletto solo se dimensione o mtime
+sono cambiati, quindi rilanciare la pipeline o selezionare un
+sottoinsieme di file già visti non legge nessun FITS.
+Gli header vengono letti con LEGGI_HEADER, senza toccare i dati.
+
+Uso:
+    cat = catalogo(main_dir+'catalogo_header.json')
+    h = cat.header(main_dir+'img0001.fits')        #dizionario keyword -> valore
+    cat.salva()
+'''
+
+CATALOGHI = {}
+
+def catalogo(cache_file):
+    cache_file = os.path.abspath(cache_file)
+    if cache_file not in CATALOGHI:
+        CATALOGHI[cache_file] = Catalogo(cache_file)
+    return CATALOGHI[cache_file]
+
+class Catalogo(object):
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.voci = {}
+        self.modificato = False
+        if os.path.exists(cache_file):
+            try:
+                f = open(cache_file)
+                self.voci = json.load(f)
+                f.close()
+            except ValueError:                                      #cache rovinata, si ricomincia
+                self.voci = {}
+
+    def header(self, nome):
+        path = os.path.abspath(nome_fits(nome))
+        st = os.stat(path)
+        voce = self.voci.get(path)
+        if voce is None or voce['size'] != st.st_size or voce['mtime'] != st.st_mtime:
+            voce = {'size': st.st_size, 'mtime': st.st_mtime, 'header': leggi_header(path)}
+            self.voci[path] = voce
+            self.modificato = True
+        return voce['header']
+
+    def salva(self):
+        if not self.modificato:
+            return
+        scrivi_json(self.cache_file, self.voci)
+        self.modificato = False
+
+'''
+Legge l'header primario di un file FITS a blocchi di 2880 byte, fermandosi
+alla card END: i dati non vengono mai letti.
+Input:
+    - path = nome del file
+Output:
+    - header = dizionario keyword -> valore (stringa, intero, float o bool)
+'''
+def leggi_header(path):
+    header = {}
+    f = open(path, 'rb')
+    try:
+        while True:
+            blocco = f.read(2880)
+            if len(blocco) < 2880:
+                raise IOError('%s: header FITS incompleto' % path)
+            for i in range(0, 2880, 80):
+                card = blocco[i:i+80]
+                key = card[:8].strip()
+                if key == 'END':
+                    return header
+                if card[8:10] != '= ':
+                    continue
+                valore = card[10:].strip()
+                if valore.startswith("'"):
+                    fine = 1
+                    while True:                                     #'' è un apice dentro la stringa
+                        fine = valore.find("'", fine)
+                        if fine < 0 or valore[fine+1:fine+2] != "'":
+                            break
+                        fine += 2
+                    header[key] = valore[1:fine].replace("''", "'").rstrip()
+                    continue
+                valore = valore.split('/')[0].strip()
+                if valore in ('T', 'F'):
+                    header[key] = valore == 'T'
+                    continue
+                try:
+                    header[key] = int(valore)
+                except ValueError:
+                    try:
+                        header[key] = float(valore.replace('D', 'E'))
+                    except ValueError:
+                        header[key] = valore
+    finally:
+        f.close()
+
+############################### CODA ################################
+'''
+Coda di lavoro su filesystem condiviso, per ridurre molte notti con più
+nodi. Ogni task è un file JSON nella cartella della coda:
+    da_fare/<id>.json   in attesa
+    in_corso/<id>.json  preso da un nodo (lease)
+    fatti/<id>.json     completato
+    falliti/<id>.json   fallito troppe volte, con l'errore
+Un nodo prende un task spostandolo con os.rename da da_fare a in_corso:
+il rename è atomico, quindi un task viene preso da un solo nodo.
+Mentre lavora il nodo rinnova la lease aggiornando l'mtime del file; se
+l'mtime è più vecchio di durata secondi (nodo caduto) il task torna in
+da_fare e viene ripreso da un altro nodo. Gli orologi dei nodi devono
+essere sincronizzati (NTP).
+L'id di un task contiene l'impronta di funzione, argomenti e, se date,
+delle impronte del contenuto dei suoi input (come in PRODOTTI): un task
+già fatto con gli stessi argomenti e gli stessi input non viene
+riaggiunto, uno con parametri diversi o con un input cambiato sotto lo
+stesso nome (es. un master ricalcolato) è un task nuovo. I task possono
+dipendere da altri task, e partono solo quando questi sono fatti.
+Il valore restituito dalla funzione viene salvato nel task fatto (vedi
+RISULTATO), es. il timbro del file prodotto.
+Le funzioni eseguibili sono solo quelle in CODA_FUNZIONI.
+
+Uso:
+    coda = Coda('/shared/coda/')
+    coda.aggiungi('notte1', 'pipeline', ['/dati/notte1/', trim_section])
+    LAVORA('/shared/coda/')                                  #su ogni nodo
+o, dalla riga di comando su ogni nodo (vedi MAIN):
+    python reduction_1.0.py --lavora /shared/coda/
+'''
+CODA_FUNZIONI = ('pipeline', 'riduci_finale', 'registra_finali')
+
+class Coda(object):
+
+    def __init__(self, coda_dir, durata = 1800, tentativi = 3):
+        self.coda_dir = os.path.join(os.path.abspath(coda_dir), '')
+        self.durata = durata
+        self.tentativi = tentativi
+        for item in ('da_fare', 'in_corso', 'fatti', 'falliti'):
+            if not os.path.isdir(self.coda_dir+item):
+                try:
+                    os.makedirs(self.coda_dir+item)
+                except OSError as e:                                #creata da un altro nodo
+                    if e.errno != errno.EEXIST:
+                        raise
+
+    def file(self, stato, id):
+        return self.coda_dir+stato+'/'+id+'.json'
+
+    def stato(self, id):
+        for item in ('fatti', 'in_corso', 'da_fare', 'falliti'):
+            if os.path.exists(self.file(item, id)):
+                return item
+        return None
+
+    def ids(self, stato):
+        return sorted(item[:-len('.json')] for item in os.listdir(self.coda_dir+stato) if item.endswith('.json'))
+
+    def id(self, nome, funzione, args = (), kwargs = {}, impronte = None):
+        firma = json.dumps([funzione, list(args), kwargs] + ([] if impronte is None else [impronte]), sort_keys = True)
+        return '%s_%s' % (''.join(c if c.isalnum() or c in '-.' else '_' for c in nome), hashlib.sha1(firma).hexdigest()[:12])
+
+    def aggiungi(self, nome, funzione, args = (), kwargs = {}, dipende = (), rifai = False, impronte = None):
+        if funzione not in CODA_FUNZIONI:
+            raise ValueError('funzione %s non eseguibile dalla coda' % funzione)
+        id = self.id(nome, funzione, args, kwargs, impronte)
+        stato = self.stato(id)
+        if stato is not None and not (rifai and stato in ('fatti', 'falliti')):
+            return id
+        if stato is not None:
+            os.remove(self.file(stato, id))
+        scrivi_json(self.file('da_fare', id), {'id': id, 'funzione': funzione, 'args': list(args), 'kwargs': kwargs, \
+                'dipende': list(dipende), 'tentativi': 0, 'errori': []})
+        return id
+
+    def leggi(self, stato, id):
+        f = open(self.file(stato, id))
+        task = json.load(f)
+        f.close()
+        return task
+
+    def sposta(self, id, da, a):
+        try:
+            os.rename(self.file(da, id), self.file(a, id))
+            return True
+        except OSError as e:                                        #spostato da un altro nodo
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def recupera(self):
+        for id in self.ids('in_corso'):
+            try:
+                scaduto = time.time()-os.path.getmtime(self.file('in_corso', id)) > self.durata
+            except OSError:
+                continue
+            if scaduto and self.sposta(id, 'in_corso', 'da_fare'):
+                print 'Coda: lease scaduta, %s torna in coda' % id
+
+    def prendi(self, nodo):
+        self.recupera()
+        fatti, falliti = set(self.ids('fatti')), set(self.ids('falliti'))   #un listdir per prendi, non uno stat per dipendenza
+        for id in self.ids('da_fare'):
+            try:
+                task = self.leggi('da_fare', id)
+            except (IOError, ValueError):                           #preso o riscritto nel frattempo
+                continue
+            if any(item in falliti for item in task['dipende']):
+                if self.sposta(id, 'da_fare', 'falliti'):
+                    task['errori'].append('dipendenza fallita')
+                    scrivi_json(self.file('falliti', id), task)
+                continue
+            if any(item not in fatti for item in task['dipende']):
+                continue
+            if not self.sposta(id, 'da_fare', 'in_corso'):
+                continue
+            task['nodo'] = nodo
+            task['inizio'] = time.time()
+            scrivi_json(self.file('in_corso', id), task)            #aggiorna anche l'mtime della lease
+            return task
+        return None
+
+    def rinnova(self, id):
+        try:
+            os.utime(self.file('in_corso', id), None)
+        except OSError:
+            pass
+
+    def risultato(self, id):
+        try:
+            return self.leggi('fatti', id).get('risultato')
+        except (IOError, ValueError):                               #non fatto
+            return None
+
+    def completa(self, task, risultato = None):
+        task['fine'] = time.time()
+        task['risultato'] = risultato
+        if self.sposta(task['id'], 'in_corso', 'fatti'):
+            scrivi_json(self.file('fatti', task['id']), task)
+
+    def fallisci(self, task, errore):
+        task['tentativi'] += 1
+        task['errori'].append(errore)
+        stato = 'da_fare' if task['tentativi'] < self.tentativi else 'falliti'
+        if self.sposta(task['id'], 'in_corso', stato):
+            scrivi_json(self.file(stato, task['id']), task)
+
+    def aperti(self):
+        return len(self.ids('da_fare'))+len(self.ids('in_corso'))
+
+'''
+Ciclo di un nodo di riduzione: prende un task dalla coda, lo esegue
+rinnovando la lease ogni durata/3 secondi e lo segna come fatto o fallito.
+Input:
+    - coda_dir = cartella della coda
+    - nodo = nome del nodo, default = hostname:pid
+    - attesa = secondi tra due controlli quando non ci sono task pronti, default = 10
+    - esci = termina quando la coda è vuota, default = True
+    - durata = durata della lease in secondi, default = 1800
+Output:
+    - numero di task eseguiti
+'''
+def lavora(coda_dir, nodo = None, attesa = 10, esci = True, durata = 1800):
+    coda = Coda(coda_dir, durata = durata)
+    if nodo is None:
+        nodo = '%s:%i' % (os.uname()[1], os.getpid())
+    eseguiti = 0
+    while True:
+        task = coda.prendi(nodo)
+        if task is None:
+            if esci and coda.aperti() == 0:
+                return eseguiti
+            time.sleep(attesa)
+            continue
+        print '############ %s: %s ############' % (nodo, task['id'])
+        fermo = threading.Event()
+        battito = threading.Thread(target = rinnova_lease, args = (coda, task['id'], fermo))
+        battito.daemon = True
+        battito.start()
+        try:
+            risultato = globals()[task['funzione']](*task['args'], **task['kwargs'])
+        except Exception as e:
+            fermo.set()
+            battito.join()
+            print 'Coda: %s fallito: %s' % (task['id'], e)
+            coda.fallisci(task, '%s: %s' % (type(e).__name__, e))
+            continue
+        fermo.set()
+        battito.join()
+        coda.completa(task, risultato)
+        eseguiti += 1
+
+def rinnova_lease(coda, id, fermo):
+    while not fermo.wait(coda.durata/3.):
+        coda.rinnova(id)
+
+'''
+Mette in coda la riduzione di più notti (una PIPELINE per notte). I nodi
+che eseguono una notte calcolano i master e mettono in coda la calibrazione
+dei singoli oggetti (vedi PIPELINE, parametro coda), che viene così divisa
+tra tutti i nodi.
+Input:
+    - coda_dir = cartella della coda
+    - notti = lista delle cartelle delle notti
+    - trim_section = sezione di trimming
+    - rifai = rimette in coda anche le notti già fatte con gli stessi
+      parametri, default = False
+    - kwargs = parametri per PIPELINE
+Output:
+    - lista degli id dei task
+'''
+def distribuisci(coda_dir, notti, trim_section, rifai = False, **kwargs):
+    coda = Coda(coda_dir)
+    kwargs.update(interattivo = False, display = False, coda = coda.coda_dir)
+    ids = []
+    for item in notti:
+        main_dir = os.path.join(os.path.abspath(item), '')
+        ids.append(coda.aggiungi(os.path.basename(main_dir[:-1]), 'pipeline', [main_dir, trim_section], kwargs, rifai = rifai))
+    return ids
+
+############################# COLLEGA ###############################
+
+'''
+Mette un file in una cartella senza copiarlo: con modo = 'hardlink' crea un
+hardlink, con 'symlink' un link simbolico al path assoluto, con 'copy' copia.
+Se l'hardlink non è possibile (es. cartelle su filesystem diversi) copia.
+Input:
+    - src = file originale
+    - dest = nuovo nome del file
+    - modo = 'hardlink', 'symlink' o 'copy', default = 'hardlink'
+'''
+def collega(src, dest, modo = 'hardlink'):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if modo == 'hardlink':
+        try:
+            os.link(src, dest)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    elif modo == 'symlink':
+        os.symlink(os.path.abspath(src), dest)
+        return
+    shutil.copy2(src, dest)
+
 ############################# COMBINE ###############################
 
 '''
-Usa imcombine per combinare le immagini. Crea una lista temporanea per
-imcombine con le immagini da combinare, aggiungendo l'estensione corretta,
-poi procede con la combinazione
+Combina le immagini. Con engine = 'iraf' usa imcombine, passandogli una
+lista temporanea (con nome univoco nella directory di lavoro) con le immagini
+da combinare, aggiungendo l'estensione corretta.
+Con engine = 'numpy' usa COMBINE_TILES, che legge le immagini a blocchi di
+righe senza caricare tutto lo stack in memoria.
+Con section le immagini vengono lette direttamente nella sezione di trimming,
+senza passare per i *.tr: IRAF riceve i nomi con la sezione (es.
+bias1[100:3996,100:3996]), COMBINE_TILES ne usa una vista sul memmap.
 
 Input:
     - lista = lista delle immagini
@@ -84,37 +677,666 @@ Input:
     - rej = criterio per la rejection, default = minmax
     - low = numero di pixel con il valore più basso da rifiutare, default = 1
     - high = numero di pixel con il valore più alto da rifiutare, default = 1
-    - debug = per ora inutilizzato
+    - engine = 'iraf' o 'numpy', default = None (vedi IRAF)
+    - max_mem = memoria massima in MB per lo stack, solo per engine = 'numpy'
+    - scale = 'median' per normalizzare le immagini alla loro mediana durante
+      la combinazione, solo per engine = 'numpy', default = None
+    - stima = stima delle mediane per scale, vedi MEDIANA, default = 'campione'
+    - section = sezione da combinare in formato IRAF, default = None (immagine intera)
+    - debug = stampa output aggiuntivi, default = False
 Output
-    - immagine combinata con imcombine
+    - immagine combinata
 '''
 
-def combine(lista, extension, out, main_dir = './', comb= 'median', rej ='minmax', low = '1', high='1', debug = False):
-    f = open('tmp_inp','w')
-    for item in lista:
-        print >>f, main_dir+item+extension
+def combine(lista, extension, out, main_dir = './', comb= 'median', rej ='minmax', low = '1', high='1', engine = None, max_mem = 512, \
+        scale = None, stima = 'campione', section = None, debug = False):
+    engine = motore(engine)
+    with TRACCIA.fase('combine', frame = out, input = [main_dir+item+extension for item in lista], output = [main_dir+out]):
+        if engine == 'numpy':
+            inp = [main_dir+item+extension for item in lista]
+            combine_tiles(inp, main_dir+out, comb = comb, rej = rej, low = low, high = high, max_mem = max_mem, \
+                    scale = scale, stima = stima, section = section, debug = debug)
+            return
+        if scale is not None:
+            raise ValueError('scale disponibile solo con engine = numpy')
+        fd, tmp_inp = tempfile.mkstemp(prefix='tmp_inp', dir=main_dir)
+        f = os.fdopen(fd,'w')
+        for item in lista:
+            print >>f, main_dir+item+extension+(section or '')
+        f.close()
+        inp='@'+tmp_inp
+        rimuovi(main_dir+out)
+        TRACCIA.conta_iraf()
+        iraf.imcombine(inp, output = main_dir+out, combine = comb, reject = rej, nlow = low, nhigh=high)
+        os.remove(tmp_inp)
+
+'''
+Combinazione out-of-core delle immagini, con la stessa semantica di imcombine
+per comb (median, average, sum), rej (minmax, none), low e high.
+Le immagini vengono aperte con memmap e lette a blocchi di righe: per ogni
+blocco si costruisce lo stack, si ordina lungo l'asse delle immagini, si
+scartano i low valori più bassi e gli high più alti e si combina il resto.
+Il numero di righe per blocco è scelto in modo che lo stack stia in max_mem MB,
+quindi la memoria usata non dipende dal numero di immagini.
+Con section si lavora su una vista del memmap: vengono lette dal disco solo
+le righe della sezione. Non scrive file temporanei. Le immagini compresse
+(vedi SCRIVI_FITS) non si possono leggere a blocchi e sono un errore.
+
+Input:
+    - inp = lista dei nomi delle immagini, con o senza .fits
+    - out = nome del file di output, con o senza .fits
+    - comb = metodo di combinazione, default = median
+    - rej = criterio per la rejection, default = minmax
+    - low, high = pixel da rifiutare; se < 1 frazione del numero di immagini
+    - max_mem = memoria massima in MB per lo stack, default = 512
+    - scale = 'median' divide ogni immagine per la sua mediana mentre viene
+      letta (flat normalizzati senza scrivere i *.n), default = None
+    - stima = come stimare le mediane, vedi MEDIANA, default = 'campione'
+    - section = sezione in formato IRAF, default = None (immagine intera)
+    - debug = stampa output aggiuntivi, default = False
+Output
+    - immagine combinata, in float32
+'''
+
+def combine_tiles(inp, out, comb = 'median', rej = 'minmax', low = '1', high = '1', max_mem = 512, \
+        scale = None, stima = 'campione', section = None, debug = False):
+    inp = [nome_fits(item) for item in inp]
+    out = nome_fits(out)
+    n = len(inp)
+    nlow, nhigh = 0, 0
+    if rej == 'minmax':
+        nlow, nhigh = float(low), float(high)
+        if nlow < 1:
+            nlow = nlow*n
+        if nhigh < 1:
+            nhigh = nhigh*n
+        nlow, nhigh = int(nlow+0.001), int(nhigh+0.001)
+        if nlow+nhigh >= n:
+            raise ValueError('minmax: %i immagini, impossibile rifiutarne %i+%i' % (n, nlow, nhigh))
+    elif rej != 'none':
+        raise ValueError('rejection %s non supportata' % rej)
+
+    hdul = [fits.open(item, memmap=True, do_not_scale_image_data=True) for item in inp]
+    hdu = [immagine(h) for h in hdul]
+    compresse = [nome for nome, h in zip(inp, hdu) if isinstance(h, fits.CompImageHDU)]
+    if compresse:                                               #verrebbero decompresse tutte, oltre max_mem
+        raise ValueError('combine_tiles: immagini compresse %s' % ', '.join(compresse))
+    header = hdu[0].header.copy()
+    dati = [h.data for h in hdu]
+    if section is not None:
+        dati = [item[sezione(section)] for item in dati]           #viste, nessuna lettura qui
+        sposta_header(header, section)
+    ny, nx = dati[0].shape
+    scala = [(h.header.get('BSCALE', 1.), h.header.get('BZERO', 0.)) for h in hdu]
+    righe = int(max_mem*1024.**2 / (2*4*n*nx))                  #x2: lo stack e la copia per il sort
+    righe = min(max(righe, 1), ny)
+    if debug:
+        print 'combine_tiles: %i immagini %ix%i, blocchi da %i righe' % (n, nx, ny, righe)
+    if scale == 'median':                                       #normalizzo ogni immagine alla sua mediana
+        mediane = [mediana(item, bscale, bzero, stima = stima) for item, (bscale, bzero) in zip(dati, scala)]
+        if debug:
+            print 'combine_tiles: mediane %s' % mediane
+        scala = [(bscale/med, bzero/med) for (bscale, bzero), med in zip(scala, mediane)]
+    elif scale is not None:
+        raise ValueError('scale %s non supportato' % scale)
+
+    risultato = np.empty((ny, nx), dtype=np.float32)
+    stack = np.empty((n, righe, nx), dtype=np.float32)
+    for y0 in range(0, ny, righe):
+        y1 = min(y0+righe, ny)
+        blocco = stack[:, :y1-y0]
+        for k in range(n):
+            blocco[k] = dati[k][y0:y1]
+            if scala[k][0] != 1.:
+                blocco[k] *= scala[k][0]
+            if scala[k][1] != 0.:
+                blocco[k] += scala[k][1]
+        if nlow or nhigh or comb == 'median':
+            blocco.sort(axis=0)
+            blocco = blocco[nlow:n-nhigh]
+        m = len(blocco)
+        if comb == 'median':
+            if m % 2:
+                risultato[y0:y1] = blocco[m//2]
+            else:
+                risultato[y0:y1] = 0.5*(blocco[m//2-1]+blocco[m//2])
+        elif comb == 'average':
+            risultato[y0:y1] = blocco.mean(axis=0)
+        elif comb == 'sum':
+            risultato[y0:y1] = blocco.sum(axis=0)
+        else:
+            raise ValueError('combinazione %s non supportata' % comb)
+    del dati, hdu
+    for h in hdul:
+        h.close()
+
+    header.pop('BSCALE', None)
+    header.pop('BZERO', None)
+    header.pop('BLANK', None)
+    header['NCOMBINE'] = n
+    if section is not None:
+        header.add_history('combine_tiles: sezione %s' % section)
+    header.add_history('combine_tiles: %s, %s nlow=%i nhigh=%i, scale %s' % (comb, rej, nlow, nhigh, scale))
+    fits.writeto(out, risultato, header, overwrite=True)
+
+############################### CUBO ####################################
+'''
+Cubo per filtro: le immagini calibrate di un filtro in un solo file FITS,
+al posto di un *.f.fits per immagine. Con migliaia di esposizioni brevi
+evita la creazione, l'apertura e lo spostamento di migliaia di file, e la
+fotometria legge tutta la notte di un filtro con una sola open.
+Struttura:
+    - HDU primaria: cubo float32 NAXIS1 x NAXIS2 x NAXIS3, un piano per immagine
+    - estensione INDICE: una riga per piano con NAME, OBJECT, EXPTIME, AIRMASS
+CREA_CUBO scrive header e indice e riserva lo spazio dei dati (file sparso),
+poi ogni processo scrive il suo piano direttamente nella sua posizione del
+file (vedi SCRIVI_PIANO): per SCRIVI_FITS un nome come cuboV.fits[*,*,3]
+è il piano 3, come per IRAF. Piani diversi si possono scrivere in parallelo.
+Ogni cubo creato ha una generazione nuova (CUBOID nell'header, vedi
+GENERAZIONE_CUBO): un task della CODA scrive il suo piano solo se il cubo
+è ancora quello per cui è stato messo in coda.
+Quando alla notte si aggiungono immagini il cubo va ricreato con un piano
+in più: con copia i piani delle immagini già calibrate vengono copiati dal
+cubo vecchio, e vanno calibrate solo le nuove. Il cubo viene comunque
+riscritto tutto (I/O, non calcolo).
+
+Lettura, con accesso diretto al piano senza leggere il resto del cubo:
+    hdul = fits.open('V/objects/final/cuboV.fits', memmap=True)
+    indice = hdul['INDICE'].data
+    data = hdul[0].data[k]                      #piano k, riga k dell'indice
+oppure LEGGI_PIANO(nome_cubo, 'sch0010'). Da IRAF: cuboV.fits[*,*,k+1].
+
+Input:
+    - nome = nome del cubo
+    - forma = (ny, nx) dei piani
+    - indice = tabella delle immagini (vedi TABELLA), con name, obj, texp e airmass
+    - header = header della HDU primaria, es. con FILTER, default = None
+    - copia = immagini i cui piani vengono copiati dal cubo nome esistente,
+      default = () (cubo tutto a zero)
+Output:
+    - generazione del cubo
+'''
+def crea_cubo(nome, forma, indice, header = None, copia = ()):
+    n = len(indice['name'])
+    primario = fits.PrimaryHDU(np.zeros((1, 1, 1), dtype=np.float32)).header
+    if header is not None:
+        for card in header.cards:
+            if card.keyword not in primario and card.keyword not in ('', 'COMMENT', 'HISTORY'):
+                primario.append(card)
+    primario['NAXIS1'] = forma[1]
+    primario['NAXIS2'] = forma[0]
+    primario['NAXIS3'] = n
+    generazione = os.urandom(8).encode('hex')
+    primario['CUBOID'] = (generazione, 'generazione del cubo')
+    blocco = primario.tostring()
+    nbyte = 4*forma[0]*forma[1]*n
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(nome)), suffix='.fits')
+    f = os.fdopen(fd, 'wb')
+    f.write(blocco)
+    f.seek(len(blocco)+-(-nbyte//2880)*2880-1)                       #dati a zero senza scriverli
+    f.write('\0')
     f.close()
-    inp='@tmp_inp' 
-    iraf.imcombine(inp, output = main_dir+out, combine = comb, reject = rej, nlow = low, nhigh=high)
-    os.remove('tmp_inp')
+    tabella = fits.BinTableHDU.from_columns([
+            fits.Column('NAME', '%iA' % max([1]+[len(item) for item in indice['name']]), array = np.asarray(indice['name'])),
+            fits.Column('OBJECT', '%iA' % max([1]+[len(item) for item in indice['obj']]), array = np.asarray(indice['obj'])),
+            fits.Column('EXPTIME', 'D', array = np.asarray(indice['texp'], dtype=np.float64)),
+            fits.Column('AIRMASS', 'E', array = np.asarray(indice['airmass'], dtype=np.float32))], name = 'INDICE')
+    fits.append(tmp, tabella.data, tabella.header)
+    if copia:
+        vecchi, offset, vecchia = indice_cubo(nome)
+        if tuple(vecchia) != tuple(forma):
+            raise ValueError('%s: piani %s, non %s' % (nome, vecchia, forma))
+        nuovi = dict((item, k) for k, item in enumerate(indice['name']))
+        npiano = 4*forma[0]*forma[1]
+        sorgente = open(nome, 'rb')
+        f = open(tmp, 'r+b')
+        for item in copia:
+            sorgente.seek(offset+npiano*vecchi[item])
+            f.seek(len(blocco)+npiano*nuovi[item])
+            f.write(sorgente.read(npiano))
+        f.close()
+        sorgente.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, nome)                                                #un cubo nuovo è un file nuovo (vedi INDICE_CUBO)
+    return generazione
+
+'''
+Generazione di un cubo (vedi CREA_CUBO), None se il file non è un cubo.
+'''
+def generazione_cubo(nome):
+    return fits.getheader(nome).get('CUBOID')
+
+'''
+Indice di un cubo: dizionario nome dell'immagine -> piano (da 0) e offset
+in byte dei dati e forma dei piani, tenuto in memoria finché il cubo non
+viene ricreato (scrivere i piani non cambia l'indice).
+'''
+CUBI = {}
+
+def indice_cubo(nome):
+    st = os.stat(nome)
+    chiave = (os.path.abspath(nome), st.st_ino, st.st_size)
+    if chiave not in CUBI:
+        hdul = fits.open(nome, memmap=True)
+        piani = dict((item, k) for k, item in enumerate(hdul['INDICE'].data['NAME']))
+        forma = hdul[0].data.shape[1:]
+        hdul.close()
+        f = open(nome, 'rb')
+        fits.Header.fromfile(f)
+        offset = f.tell()                                               #i dati iniziano dopo l'header
+        f.close()
+        CUBI[chiave] = (piani, offset, forma)
+    return CUBI[chiave]
+
+'''
+Nome del piano di image nel cubo, nella notazione di IRAF (da 1), per
+SCRIVI_FITS: es. cuboV.fits[*,*,3].
+'''
+def piano(nome, image):
+    return '%s[*,*,%i]' % (nome, indice_cubo(nome)[0][image]+1)
+
+'''
+Scrive data nel piano k (da 1) del cubo, con una sola write nella sua
+posizione del file. L'header dell'immagine non viene scritto: le
+informazioni sulle immagini sono nell'INDICE.
+'''
+def scrivi_piano(nome, k, data):
+    piani, offset, forma = indice_cubo(nome)
+    if not 1 <= k <= len(piani) or tuple(np.shape(data)) != tuple(forma):
+        raise ValueError('%s: piano %i %s non valido' % (nome, k, np.shape(data)))
+    f = open(nome, 'r+b')
+    f.seek(offset+4*forma[0]*forma[1]*(k-1))
+    f.write(np.asarray(data, dtype='>f4').tostring())
+    f.close()
+
+'''
+Legge il piano di un'immagine dal cubo, con memmap: dal disco viene letto
+solo quel piano, quando si usano i dati.
+Input:
+    - nome = nome del cubo
+    - image = nome dell'immagine o numero del piano (da 0)
+Output:
+    - data = piano, in float32
+    - riga = riga dell'INDICE (NAME, OBJECT, EXPTIME, AIRMASS)
+'''
+def leggi_piano(nome, image):
+    hdul = fits.open(nome, memmap=True)
+    k = image if isinstance(image, (int, np.integer)) else indice_cubo(nome)[0][image]
+    return hdul[0].data[k], hdul['INDICE'].data[k]
+
+############################### DARK ####################################
+'''
+Scelta del master dark per il tempo di esposizione di ogni immagine.
+INDICE_DARK tiene i tempi dei master ordinati e con CERCA trova con bisect,
+in O(log n), il dark per un tempo texp:
+    - il master più vicino, se il suo tempo differisce da texp al più di
+      tolleranza*texp (i tempi negli header non sono sempre identici)
+    - altrimenti, con scala = True, un dark scalato: i master sono già
+      corretti per bias e linearizzati, quindi master/tempo è la corrente
+      di buio e il dark per texp è master*texp/tempo. Si scala il master più
+      corto tra quelli più lunghi di texp (scalando verso il basso il rumore
+      diminuisce), o il più lungo se texp li supera tutti
+    - altrimenti nessun dark
+Con engine = 'numpy' il dark scalato viene calcolato da DARK_SCALATO e
+tenuto in memoria, uno per master, come MASTER per i master.
+
+Input:
+    - master = dizionario tempo di esposizione -> nome del master dark
+    - tolleranza = differenza relativa massima tra i tempi, default = 0.01
+    - scala = sintetizza i dark scalati, default = True
+Output (CERCA):
+    - nome del master, o None se non c'è un dark per texp
+    - fattore di scala, 1. per un master usato così com'è
+'''
+class IndiceDark(object):
+
+    def __init__(self, master, tolleranza = 0.01, scala = True):
+        self.tempi = sorted(float(item) for item in master)
+        self.nomi = [master[item] for item in sorted(master, key = float)]
+        self.tolleranza = tolleranza
+        self.scala = scala
+
+    def cerca(self, texp):
+        texp = float(texp)
+        i = bisect.bisect_left(self.tempi, texp)
+        vicini = [j for j in (i-1, i) if 0 <= j < len(self.tempi)]
+        if len(vicini) == 0:
+            return None, 1.
+        j = min(vicini, key = lambda j: abs(self.tempi[j]-texp))
+        if abs(self.tempi[j]-texp) <= self.tolleranza*texp:
+            return self.nomi[j], 1.
+        j = min(i, len(self.tempi)-1)                                   #il primo più lungo, o il più lungo
+        if not self.scala or texp <= 0 or self.tempi[j] <= 0:
+            return None, 1.
+        return self.nomi[j], texp/self.tempi[j]
+
+'''
+Master dark mdark moltiplicato per scala, in memoria. Si tiene un solo
+dark scalato per master, l'ultimo usato: la memoria resta al più quella
+dei MASTER anche con molti tempi di esposizione, e viene ricalcolato solo
+quando cambia il fattore di scala (una moltiplicazione).
+'''
+SCALATI = {}
+
+def dark_scalato(mdark, scala = 1.):
+    if scala == 1.:
+        return master(mdark)
+    nome = os.path.abspath(nome_fits(mdark))
+    st = os.stat(nome)
+    chiave = (st.st_mtime, st.st_size, scala)
+    if nome not in SCALATI or SCALATI[nome][0] != chiave:
+        SCALATI[nome] = (chiave, master(nome)*np.float32(scala))
+    return SCALATI[nome][1]
+
+############################## FLUSSO ###################################
+'''
+Lettura e scrittura dei frame in thread separati, per sovrapporre l'I/O
+(su dischi di rete conta soprattutto la latenza) ai calcoli.
+
+FLUSSO esegue una funzione di riduzione (RIDUCI_FRAME, RIDUCI_FLAT,
+RIDUCI_OGGETTO con engine = 'numpy') su una lista di frame:
+    - un LETTORE legge in anticipo fino ad avanti frame, con thread paralleli,
+      e li passa alla funzione nell'ordine della lista
+    - uno SCRITTORE scrive i risultati in background, con una coda di al
+      massimo avanti frame
+Le code sono limitate: se il calcolo è lento le letture si fermano, se il
+disco è lento si ferma il calcolo. In memoria ci sono al massimo circa
+2*avanti+2 frame; avanti viene scelto in modo che stiano in memoria MB.
+Ogni argomento della lista ha il nome dell'immagine e la sua cartella
+come primi due elementi, come per le funzioni RIDUCI.
+
+Input:
+    - funzione = funzione di riduzione, deve accettare dati e scrittore
+    - argomenti = lista delle tuple di argomenti, una per frame
+    - section = sezione da leggere in formato IRAF
+    - memoria = memoria massima in MB per i frame in coda, default = 512
+    - thread = thread di lettura, default = 2
+    - kwargs = argomenti aggiuntivi per funzione
+'''
+def flusso(funzione, argomenti, section, memoria = 512, thread = 2, **kwargs):
+    argomenti = list(argomenti)
+    if len(argomenti) == 0:
+        return
+    nomi = [item[1]+item[0] for item in argomenti]
+    header = fits.getheader(nome_fits(nomi[0]))
+    sy, sx = sezione(section)
+    nbyte = 4*len(range(*sy.indices(header['NAXIS2'])))*len(range(*sx.indices(header['NAXIS1'])))
+    avanti = max(1, int(memoria*1024.**2/(2*nbyte)))
+    lettore = Lettore(nomi, section, avanti = avanti, thread = thread)
+    scrittore = Scrittore(coda = avanti)
+    try:
+        for i, dati in enumerate(lettore):                              #un frame alla volta, zip li leggerebbe tutti
+            funzione(*argomenti[i], dati = dati, scrittore = scrittore, **kwargs)
+    finally:
+        lettore.chiudi()
+        scrittore.chiudi()
+
+'''
+Divide una lista di task in n parti, per lanciare un FLUSSO per processo.
+'''
+def dividi(lista, n):
+    return [lista[i::n] for i in range(max(1, n)) if len(lista[i::n])]
+
+'''
+LETTORE: iteratore sui frame (data, header) letti con CARICA da thread in
+background, nello stesso ordine dei nomi. I frame vengono letti senza
+memmap, così la lettura avviene in blocco e libera il GIL.
+Un errore di lettura viene rilanciato quando si arriva a quel frame.
+CHIUDI ferma le letture non ancora partite.
+'''
+class Lettore(object):
+
+    def __init__(self, nomi, section = None, avanti = 4, thread = 2):
+        self.nomi = nomi
+        self.section = section
+        self.risultati = [Queue.Queue(1) for item in nomi]
+        self.posti = threading.Semaphore(avanti)                        #frame letti e non ancora consumati
+        self.fermo = False
+        self.indici = Queue.Queue()
+        self.thread = [threading.Thread(target = self.alimenta)]
+        self.thread += [threading.Thread(target = self.leggi) for i in range(thread)]
+        self.n = thread
+        for item in self.thread:
+            item.daemon = True
+            item.start()
+
+    def alimenta(self):
+        for i in range(len(self.nomi)):                                 #i frame partono in ordine, mai oltre avanti
+            self.posti.acquire()
+            if self.fermo:
+                break
+            self.indici.put(i)
+        for i in range(self.n):
+            self.indici.put(None)
+
+    def leggi(self):
+        while True:
+            i = self.indici.get()
+            if i is None:
+                return
+            if self.fermo:
+                continue
+            try:
+                risultato = carica(self.nomi[i], self.section, memmap = False)
+            except Exception as e:
+                risultato = e
+            self.risultati[i].put(risultato)
+
+    def __iter__(self):
+        for i in range(len(self.nomi)):
+            risultato = self.risultati[i].get()
+            self.posti.release()
+            if isinstance(risultato, Exception):
+                raise risultato
+            yield risultato
+
+    def chiudi(self):
+        self.fermo = True
+        self.posti.release()
+        for item in self.thread:
+            item.join()
+
+'''
+SCRITTORE: scrive le immagini in un thread in background, con la loro
+ANTEPRIMA se richiesta.
+SCRIVI mette in coda l'immagine e si blocca se la coda è piena;
+CHIUDI aspetta che tutte le immagini siano scritte e rilancia il primo
+errore di scrittura.
+'''
+class Scrittore(object):
+
+    def __init__(self, coda = 4):
+        self.coda = Queue.Queue(coda)
+        self.errore = None
+        self.thread = threading.Thread(target = self.lavora)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def scrivi(self, nome, data, header, formato = 'float32', png = None):
+        if self.errore is not None:
+            raise self.errore
+        self.coda.put((nome, data, header, formato, png))
+
+    def lavora(self):
+        while True:
+            item = self.coda.get()
+            if item is None:
+                return
+            if self.errore is not None:
+                continue
+            try:
+                scrivi_fits(*item[:4])
+                if item[4] is not None:
+                    anteprima(item[1], item[4])
+            except Exception as e:
+                self.errore = e
+
+    def chiudi(self):
+        self.coda.put(None)
+        self.thread.join()
+        if self.errore is not None:
+            raise self.errore
+
+############################## FORMATO ##################################
+'''
+Scrive un'immagine nel formato richiesto. Formati:
+    - 'float32' = float a 4 byte, come le immagini real di IRAF (default)
+    - 'uint16' = interi a 2 byte con BZERO = 32768: senza perdite per
+      immagini con valori interi tra 0 e 65535 (es. frame grezzi tagliati).
+      Il valore -32768 (cioè 0) è BLANK solo se ci sono pixel non finiti,
+      e in quel caso il minimo è 1. Valori fuori intervallo sono un errore
+      (ValueError), non vengono tagliati
+    - 'int16' = interi a 2 byte scalati con BSCALE/BZERO sull'intervallo
+      dei dati: errore massimo mezzo BSCALE, (max-min)/131068
+    - 'rice' = compressione a tile RICE_1 di un float quantizzato; con
+      'rice:q' il livello di quantizzazione è q (il passo di quantizzazione
+      è il rumore della tile diviso q), default q = 16
+    - 'gzip' = compressione a tile GZIP_1 del float senza quantizzazione,
+      senza perdite; con 'gzip:q' il float viene quantizzato come per 'rice'
+Le immagini compresse sono nella prima estensione, vanno lette con CARICA
+o IMMAGINE. IRAF non legge le immagini compresse e COMBINE_TILES le
+rifiuta (andrebbero decompresse tutte in memoria): vanno usate solo per
+i finali.
+Un nome come cuboV.fits[*,*,3] è un piano di un CUBO già creato: il piano
+viene scritto in float32 e l'header ignorato (vedi SCRIVI_PIANO).
+Input:
+    - nome = nome del file
+    - data = array dell'immagine
+    - header = header
+    - formato = formato, default = 'float32'
+'''
+FORMATI = ('float32', 'uint16', 'int16', 'rice', 'gzip')
+COMPRESSI = ('rice', 'gzip')
+
+def scrivi_fits(nome, data, header = None, formato = 'float32'):
+    if nome.endswith(']'):                                              #piano di un CUBO
+        cubo, _, k = nome[:-1].rpartition('[')
+        scrivi_piano(cubo, int(k.split(',')[-1]), data)
+        return
+    tipo, _, q = formato.partition(':')
+    if tipo not in FORMATI:
+        raise ValueError('formato %s non supportato' % formato)
+    header = fits.Header() if header is None else header.copy()
+    for item in ('BSCALE', 'BZERO', 'BLANK'):
+        header.pop(item, None)
+    if tipo in COMPRESSI:
+        compressa = fits.CompImageHDU(np.asarray(data, dtype=np.float32), header, \
+                compression_type = {'rice': 'RICE_1', 'gzip': 'GZIP_1'}[tipo], \
+                quantize_level = float(q or (16. if tipo == 'rice' else 0.)))
+        fits.HDUList([fits.PrimaryHDU(), compressa]).writeto(nome, overwrite=True)
+        return
+    if tipo == 'float32':
+        fits.writeto(nome, np.asarray(data, dtype=np.float32), header, overwrite=True)
+        return
+    validi = np.isfinite(data)
+    if tipo == 'uint16':
+        bscale, bzero = 1., 32768.
+    else:
+        basso, alto = (float(data[validi].min()), float(data[validi].max())) if validi.any() else (0., 0.)
+        bscale = (alto-basso)/65534. or 1.
+        bzero = basso+32767.*bscale
+    interi = np.round((data-bzero)/bscale)
+    minimo = -32768 if validi.all() else -32767                                 #-32768 libero se non serve BLANK
+    if validi.any() and (interi[validi].min() < minimo or interi[validi].max() > 32767):
+        raise ValueError('%s: valori tra %g e %g, fuori dall\'intervallo di %s' \
+                % (nome, np.nanmin(data[validi]), np.nanmax(data[validi]), formato))
+    np.clip(interi, minimo, 32767, out=interi)
+    interi = interi.astype(np.int16)
+    if not validi.all():
+        interi[~validi] = -32768
+        header['BLANK'] = -32768
+    hdu = fits.PrimaryHDU(interi, header, do_not_scale_image_data=True)
+    hdu.header['BSCALE'] = bscale
+    hdu.header['BZERO'] = bzero
+    hdu.writeto(nome, overwrite=True)
+
+'''
+Riscrive un'immagine esistente in un altro formato (es. un finale scritto
+da IRAF in float da comprimere).
+'''
+def converti(nome, formato):
+    if formato == 'float32':
+        return
+    data, header = carica(nome, memmap = False)
+    scrivi_fits(nome_fits(nome), data, header, formato)
 
+'''
+HDU con l'immagine in un file aperto: la primaria, oppure la prima
+estensione per le immagini compresse (vedi SCRIVI_FITS).
+'''
+def immagine(hdul):
+    if len(hdul) > 1 and isinstance(hdul[1], fits.CompImageHDU):
+        return hdul[1]
+    return hdul[0]
 
 ############################### HSEL #################################
 
 '''
-Crea una lista con le caratteristiche delle osservazioni utilizzando hselect. 
+Crea una lista con le caratteristiche delle osservazioni.
+Con i campi di default legge gli header dal CATALOGO (nessuna chiamata a IRAF,
+i file già visti non vengono riletti); con altri campi usa hselect, o
+ancora il CATALOGO con engine = 'numpy': in questo caso le colonne si
+chiamano come le keyword in minuscolo ('name' per $I) e sono numeriche
+se tutti i valori sono numeri.
 
 Input:
-    - files = nome del file, come su iraf
+    - files = nome del file, come su iraf: un pattern (es. './*.fits')
+              o una lista su file ('@lista'); oppure una lista di nomi
     - field = campi da estrarre con hselect, default = '$I,OBJECT,IMAGETYP,FILTER,EXPTIME,AIRMASS'
               per il settagio di seguito sno gli unici ora supportati
     - main_dir = directory di lavoro, default = './'
+    - cache = file del catalogo degli header, default = main_dir+'catalogo_header.json'
+    - engine = backend per i campi non di default, 'iraf' o 'numpy',
+      default = None (vedi IRAF)
     - debug = stampa output aggiuntivi, default = False
 
 Output
     - ss = tabella con le informazioni selezionate
 '''
-def hsel(files, field = '$I,OBJECT,IMAGETYP,FILTER,EXPTIME,AIRMASS', main_dir='./', debug=False):
+HSEL_DTYPE = [('name','S64'),('obj','S32'),('type','S16') ,('filter','S8'),('texp','d'), ('airmass','f')]
+
+def hsel(files, field = '$I,OBJECT,IMAGETYP,FILTER,EXPTIME,AIRMASS', main_dir='./', cache = None, engine = None, debug=False):
+    if cache is None:
+        cache = main_dir+'catalogo_header.json'
+    if field == '$I,OBJECT,IMAGETYP,FILTER,EXPTIME,AIRMASS':
+        cat = catalogo(cache)
+        righe = []
+        for item in espandi(files):
+            h = cat.header(item)
+            righe.append((os.path.basename(item)[:-len('.fits')], h.get('OBJECT', ''), h.get('IMAGETYP', ''), \
+                    h.get('FILTER', ''), h.get('EXPTIME', np.nan), h.get('AIRMASS', np.nan)))
+            if debug:
+                print '\t'.join([str(v) for v in righe[-1]])
+        cat.salva()
+        dtype = []                                                  #stringhe larghe quanto serve, niente troncamenti
+        for j, (campo, tipo) in enumerate(HSEL_DTYPE):
+            if tipo.startswith('S'):
+                tipo = 'S%i' % max([1]+[len(str(item[j])) for item in righe])
+            dtype.append((campo, tipo))
+        return np.array(righe, dtype=dtype)
+
+    if motore(engine) == 'numpy':
+        campi = [item.strip() for item in field.split(',')]
+        cat = catalogo(cache)
+        righe = []
+        for item in espandi(files):
+            h = cat.header(item)
+            righe.append(tuple(os.path.basename(item)[:-len('.fits')] if campo == '$I' else h.get(campo.upper(), '') \
+                    for campo in campi))
+            if debug:
+                print '\t'.join([str(v) for v in righe[-1]])
+        cat.salva()
+        dtype = []
+        for j, campo in enumerate(campi):
+            valori = [item[j] for item in righe]
+            if len(valori) and all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in valori):
+                tipo = 'd'
+            else:
+                tipo = 'S%i' % max([1]+[len(str(v)) for v in valori])
+            dtype.append(('name' if campo == '$I' else campo.lower(), tipo))
+        return np.array(righe, dtype=dtype)
+
+    TRACCIA.conta_iraf()
     s = iraf.hselect(files,fields = field, expr='yes',Stdout=1)
     f=open(main_dir+'list_tmp','w')
     l = len(main_dir)
@@ -123,91 +1345,593 @@ def hsel(files, field = '$I,OBJECT,IMAGETYP,FILTER,EXPTIME,AIRMASS', main_dir='.
         if debug:
             print i
     f.close()
-    ss = np.genfromtxt(main_dir+'list_tmp',delimiter='\t', dtype=[('name','S7'),('obj','S15'),('type','S7') ,('filter','S2'),('texp','d'), ('airmass','f')])
+    ss = np.genfromtxt(main_dir+'list_tmp',delimiter='\t', dtype=HSEL_DTYPE)
     if not debug:
         os.remove(main_dir+'list_tmp')
     return ss
 
+'''
+Espande un input di file come su IRAF: '@lista' legge i nomi dal file lista,
+altrimenti il nome viene usato come pattern. Accetta anche una lista python
+di nomi. Restituisce i nomi con .fits.
+'''
+def espandi(files):
+    if not isinstance(files, basestring):
+        nomi = list(files)
+    elif files.startswith('@'):
+        f = open(files[1:])
+        nomi = [item.strip() for item in f if item.strip()]
+        f.close()
+    else:
+        nomi = sorted(glob.glob(nome_fits(files)))
+    return [nome_fits(item) for item in nomi]
+
+############################### IRAF ##################################
+'''
+Backend IRAF caricato solo quando serve: PyRAF e i pacchetti noao, imred
+e irred vengono importati al primo task IRAF lanciato (iraf.imcombine,
+iraf.imarith, ...), non all'import del modulo. Una query sugli header, una
+riduzione con engine = 'numpy' o i processi di PARALLELO che non usano
+IRAF non pagano l'inizializzazione di PyRAF e non hanno bisogno di IRAF.
+USA_UPARM sceglie la cartella uparm dei parametri dei task, anche prima
+che IRAF sia caricato (vedi PARALLELO).
+
+Le funzioni con un backend NumPy (COMBINE, OPERATION, STATS, TRIM,
+LINEARIZE, HSEL, PIPELINE) hanno un parametro engine; engine = None usa
+ENGINE, che vale:
+    - la variabile d'ambiente SCHMIDT_ENGINE ('iraf' o 'numpy'), se definita
+    - altrimenti 'iraf' se PyRAF è installato, 'numpy' se non lo è
+'''
+class IrafPigro(object):
+
+    def __init__(self):
+        self.modulo = None
+        self.uparm = None
+
+    def carica(self):
+        if self.modulo is None:
+            from pyraf import iraf
+            iraf.noao(_doprint=0)
+            iraf.imred(_doprint=0)
+            iraf.irred(_doprint=0)
+            self.modulo = iraf
+            if self.uparm is not None:
+                iraf.set(uparm = self.uparm)
+        return self.modulo
+
+    def usa_uparm(self, uparm):
+        if not os.path.isdir(uparm):
+            os.makedirs(uparm)
+        self.uparm = uparm
+        if self.modulo is not None:
+            self.modulo.set(uparm = uparm)
+
+    def __getattr__(self, nome):
+        return getattr(self.carica(), nome)
+
+iraf = IrafPigro()
+
+def pyraf_installato():
+    try:
+        imp.find_module('pyraf')                                    #cerca il pacchetto senza importarlo
+        return True
+    except ImportError:
+        return False
+
+ENGINE = os.environ.get('SCHMIDT_ENGINE') or ('iraf' if pyraf_installato() else 'numpy')
+
+def motore(engine = None):
+    if engine is None:
+        engine = ENGINE
+    if engine not in ('iraf', 'numpy'):
+        raise ValueError('engine %s non supportato' % engine)
+    return engine
+
+############################# LIBRERIA ###############################
+'''
+Libreria dei master di calibrazione condivisa tra più notti.
+I master (mbias, dark, mflat) vengono copiati in lib_dir/<data>/ e indicizzati
+in lib_dir/indice.json per tipo, data della notte, binning, sezione di
+trimming, tempo di esposizione (dark), filtro (flat) e coefficienti di
+linearizzazione (dark e flat).
+CERCA restituisce il master compatibile con la data più vicina a quella
+richiesta, purché entro validita giorni, altrimenti None.
+PUBBLICA rilegge l'indice sotto un lockfile (indice.lock, creato con
+O_EXCL) prima di riscriverlo, così notti ridotte in parallelo non perdono
+le voci pubblicate dalle altre.
+
+Uso:
+    lib = Libreria('/data/schmidt/masters')
+    mbias = lib.cerca('bias', '2017-01-12', '1x1', trim_section, validita = 30)
+    lib.pubblica(bias_dir+'mbias.fits', 'bias', '2017-01-12', '1x1', trim_section)
+'''
+class Libreria(object):
+
+    def __init__(self, lib_dir):
+        self.lib_dir = os.path.abspath(lib_dir)+'/'
+        self.indice_file = self.lib_dir+'indice.json'
+        self.lock_file = self.lib_dir+'indice.lock'
+        if not os.path.isdir(self.lib_dir):
+            os.makedirs(self.lib_dir)
+        self.indice = self.leggi()
+
+    def leggi(self):
+        if not os.path.exists(self.indice_file):
+            return []
+        f = open(self.indice_file)
+        indice = json.load(f)
+        f.close()
+        return indice
+
+    def blocca(self, scadenza = 60.):
+        while True:
+            try:
+                os.close(os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0644))
+                return
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                vecchio = time.time()-os.path.getmtime(self.lock_file) > scadenza
+            except OSError:                                         #appena rilasciato
+                continue
+            if vecchio:                                             #lasciato da un processo interrotto
+                try:
+                    os.remove(self.lock_file)
+                except OSError:
+                    pass
+                continue
+            time.sleep(0.1)
+
+    def sblocca(self):
+        try:
+            os.remove(self.lock_file)
+        except OSError:
+            pass
+
+    def chiave(self, tipo, binning, trim_section, texp = None, filtro = None, co = None):
+        return {'tipo': tipo, 'binning': binning, 'trim_section': trim_section, \
+                'texp': texp, 'filtro': filtro, 'co': co}
+
+    def cerca(self, tipo, data, binning, trim_section, validita = 30, texp = None, filtro = None, co = None):
+        chiave = self.chiave(tipo, binning, trim_section, texp, filtro, co)
+        giorno = data_notte(data)
+        migliore, distanza = None, None
+        for voce in self.indice:
+            if any([voce[k] != v for k, v in chiave.items() if k not in ('texp', 'co')]):
+                continue
+            if texp is not None and abs(voce['texp']-texp) > 1e-3:
+                continue
+            if co is not None and not np.allclose(voce['co'], co):
+                continue
+            d = abs((data_notte(voce['data'])-giorno).days)
+            if d <= validita and (distanza is None or d < distanza):
+                migliore, distanza = voce, d
+        if migliore is None or not os.path.exists(migliore['path']):
+            return None
+        return migliore['path']
+
+    def pubblica(self, nome, tipo, data, binning, trim_section, texp = None, filtro = None, co = None):
+        dest_dir = self.lib_dir+data+'/'
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        voce = self.chiave(tipo, binning, trim_section, texp, filtro, co)
+        firma = hashlib.sha1(json.dumps(voce, sort_keys=True)).hexdigest()[:8]   #master diversi della stessa notte
+        dest = dest_dir+os.path.basename(nome_fits(nome))[:-len('.fits')]+'_'+firma+'.fits'
+        shutil.copy2(nome_fits(nome), dest)
+        voce['data'] = data
+        voce['path'] = dest
+        self.blocca()                                               #altre notti possono pubblicare insieme
+        try:
+            self.indice = [item for item in self.leggi() if item['path'] != dest]
+            self.indice.append(voce)
+            scrivi_json(self.indice_file, self.indice, indent=1)
+        finally:
+            self.sblocca()
+
+'''
+Data della notte (YYYY-MM-DD) da una data FITS (DATE-OBS). Le osservazioni
+prima di mezzogiorno appartengono alla notte precedente.
+Con un datetime.date restituisce il giorno corrispondente.
+'''
+def data_notte(data):
+    if isinstance(data, datetime.date):
+        return data
+    data = data.strip()
+    giorno = datetime.datetime.strptime(data[:10], '%Y-%m-%d')
+    if len(data) >= 13 and data[10] == 'T' and int(data[11:13]) < 12:
+        giorno -= datetime.timedelta(days = 1)
+    return giorno.date()
+
+'''
+Data della notte e binning di un gruppo di frame, letti dal CATALOGO degli
+header (DATE-OBS, XBINNING/YBINNING o CCDSUM).
+Input:
+    - nomi = lista dei file
+    - cache = file del catalogo degli header
+Output:
+    - data = data della notte, 'YYYY-MM-DD'
+    - binning = es. '1x1'
+'''
+def descrivi_notte(nomi, cache):
+    cat = catalogo(cache)
+    date = []
+    binning = 'unknown'
+    for item in nomi:
+        h = cat.header(item)
+        if 'DATE-OBS' in h:
+            date.append(data_notte(h['DATE-OBS']))
+        if 'XBINNING' in h:
+            binning = '%ix%i' % (h['XBINNING'], h.get('YBINNING', h['XBINNING']))
+        elif 'CCDSUM' in h:
+            binning = 'x'.join(str(h['CCDSUM']).split())
+    cat.salva()
+    if not date:
+        raise ValueError('DATE-OBS mancante, impossibile datare la notte')
+    return min(date).isoformat(), binning
+
+'''
+Decide come ottenere un master in PIPELINE. Se il master è aggiornato
+(vedi PRODOTTI) non fa niente; se la libreria ha un master compatibile
+(trovato, da Libreria.cerca) lo copia in out; altrimenti il master va
+costruito a partire dagli input locali.
+Input:
+    - out = nome del master
+    - input = input locali del master
+    - trovato = master trovato in libreria, o None
+    - prodotti = grafo dei prodotti della notte
+    - parametri = parametri della riduzione
+Output:
+    - True se il master va costruito
+'''
+def serve_master(out, input, trovato, prodotti, parametri):
+    if trovato is not None:
+        input = [trovato]
+    if prodotti.aggiornato(out, input, parametri):
+        print '%s aggiornato' % out
+        return False
+    if trovato is None:
+        return True
+    print '%s dalla libreria: %s' % (out, trovato)
+    shutil.copy(trovato, nome_fits(out))
+    prodotti.registra(out, input, parametri)
+    prodotti.salva()
+    return False
+
 ############################# LINEARIZE ###############################
 '''
-Usa irlincor per linearizzare le immagini del CCD Schmidt
+Usa irlincor per linearizzare le immagini del CCD Schmidt.
+Con engine = 'numpy' legge l'immagine, la linearizza in memoria con
+LINEARIZZA_ARRAY e la scrive, senza lanciare task IRAF.
 Input:
     - inp = nome immagine come da IRAF
     - out = nome immagine di output, come da IRAF
     - coeff1, ..., coeff3 = coefficienti per la linearizzazione. Default valori per CCD nuovo
     CCD nuovo = [1., -0.10140076, 0.034650755]
     SBIG = [1., 0., 0.0133]
+    - engine = 'iraf' o 'numpy', default = None (vedi IRAF)
+    - lincor = 'polinomio' o 'tabella', solo per engine = 'numpy' (vedi LINEARIZZA_ARRAY)
+    - formato = formato di output per engine = 'numpy', vedi SCRIVI_FITS
 '''
 #linearizzazione immagini
-def linearize(inp, out, co1 = 1., co2 = -0.10140076, co3 = 0.034650755, debug = False):
+def linearize(inp, out, co1 = 1., co2 = -0.10140076, co3 = 0.034650755, engine = None, lincor = 'polinomio', \
+        formato = 'float32', debug = False):
+    if motore(engine) == 'numpy':
+        data, header = carica(inp)
+        linearizza_array(data, co1, co2, co3, lincor = lincor)
+        header.add_history('linearize: [%g,%g,%g] %s' % (co1, co2, co3, lincor))
+        scrivi_fits(nome_fits(out), data, header, formato)
+        return
+    rimuovi(out)
+    TRACCIA.conta_iraf()
     iraf.irlincor(input = inp, output = out, coeff1 = co1, coeff2 = co2, coeff3 = co3)
 
+'''
+Stessa correzione di irlincor, applicata direttamente a un array in memoria:
+    out = in * (coeff1 + coeff2 * (in/32767) + coeff3 * (in/32767)**2)
+L'array viene modificato sul posto, a blocchi di elementi: i buffer di
+lavoro sono allocati una volta e restano in cache, quindi il costo è una
+sola passata sui dati.
+Con lincor = 'tabella' il polinomio non viene valutato: si usa la tabella
+della correzione su tutto l'intervallo di ADU del rivelatore (vedi
+TABELLA_LINEARE), interpolata linearmente per i valori non interi.
+L'errore di interpolazione è sotto 1e-5 ADU; i pixel fuori dalla tabella
+sono corretti con il polinomio. Con numpy gli accessi indicizzati alla
+tabella costano più delle tre moltiplicazioni del polinomio, che quindi
+resta il default.
+Input:
+    - data = array da linearizzare (float)
+    - co1, ..., co3 = coefficienti per la linearizzazione
+    - lincor = 'polinomio' o 'tabella', default = 'polinomio'
+    - blocco = elementi per blocco, default = 2**18
+Output:
+    - data = array linearizzato
+'''
+def linearizza_array(data, co1 = 1., co2 = -0.10140076, co3 = 0.034650755, lincor = 'polinomio', blocco = 2**18, debug = False):
+    if not data.flags.c_contiguous:
+        data[...] = linearizza_array(np.ascontiguousarray(data), co1, co2, co3, lincor = lincor, blocco = blocco)
+        return data
+    if lincor == 'tabella':
+        valore, pendenza, minimo = tabella_lineare(co1, co2, co3)
+        massimo = len(valore)-1
+    elif lincor != 'polinomio':
+        raise ValueError('lincor %s non supportato' % lincor)
+    piatto = data.reshape(-1)
+    t = np.empty(min(blocco, piatto.size), dtype=np.float64)        #buffer in doppia: indici esatti fino a 65535
+    p = np.empty_like(t)
+    for i0 in range(0, piatto.size, blocco):
+        b = piatto[i0:i0+blocco]
+        n = len(b)
+        if lincor == 'polinomio':
+            np.multiply(b, 1/32767., out=t[:n])
+            np.multiply(t[:n], co3, out=p[:n])
+            p[:n] += co2
+            p[:n] *= t[:n]
+            p[:n] += co1
+            b *= p[:n]
+            continue
+        t[:n] = b
+        t[:n] -= minimo
+        with np.errstate(invalid = 'ignore'):                       #NaN: pixel BLANK
+            fuori = np.flatnonzero(~np.isfinite(t[:n]) | (t[:n] < 0) | (t[:n] > massimo))
+        originali = b[fuori]
+        t[fuori] = 0                                                #indici validi, riscritti dal polinomio
+        indici = t[:n].astype(np.intp)
+        t[:n] -= indici                                             #parte frazionaria
+        np.take(pendenza, indici, out=p[:n])
+        p[:n] *= t[:n]
+        np.take(valore, indici, out=t[:n])
+        np.add(t[:n], p[:n], out=b)
+        if len(fuori):
+            x = originali/32767.
+            b[fuori] = originali*(co1+x*(co2+co3*x))
+    return data
+
+'''
+Tabella della correzione di linearità per ogni ADU intero tra minimo e
+massimo, con la pendenza verso il valore successivo per l'interpolazione.
+Le tabelle sono calcolate una volta per processo per ogni set di
+coefficienti (es. CCD nuovo e SBIG) e tenute in LINEARE.
+Input:
+    - co1, ..., co3 = coefficienti per la linearizzazione
+    - minimo, massimo = intervallo di ADU, default = -4096, 65535
+Output:
+    - valore, pendenza = tabelle float64
+    - minimo = ADU del primo elemento
+'''
+LINEARE = {}
+
+def tabella_lineare(co1, co2, co3, minimo = -4096, massimo = 65535):
+    chiave = (co1, co2, co3, minimo, massimo)
+    if chiave not in LINEARE:
+        v = np.arange(minimo, massimo+2, dtype=np.float64)
+        x = v/32767.
+        t = v*(co1+x*(co2+co3*x))
+        LINEARE[chiave] = (t[:-1], np.diff(t), minimo)
+    return LINEARE[chiave]
+
+############################# MASTER ###############################
+'''
+Restituisce un master (mbias, dark, mflat) come array in memoria.
+Ogni master viene letto una sola volta per processo; se il file cambia
+(mtime o dimensione diversi) viene riletto e prende il posto della
+versione vecchia, così un master ricostruito più volte (es. con
+SORVEGLIA) occupa sempre la memoria di un solo frame.
+Input:
+    - nome = nome del master, con o senza .fits
+Output:
+    - array del master
+'''
+MASTER = {}
+
+def master(nome):
+    nome = os.path.abspath(nome_fits(nome))
+    st = os.stat(nome)
+    chiave = (st.st_mtime, st.st_size)
+    if nome not in MASTER or MASTER[nome][0] != chiave:
+        MASTER[nome] = (chiave, carica(nome)[0])
+    return MASTER[nome][1]
+
+############################# MEDIANA ###############################
+'''
+Mediana di un'immagine, anche memory-mapped, senza caricarla tutta.
+I valori sono letti grezzi e riscalati con bscale e bzero.
+Stime possibili:
+    - 'esatta' = mediana di tutti i pixel (legge l'immagine intera)
+    - 'campione' = mediana di un pixel ogni passo in x e in y
+    - 'istogramma' = istogramma di tutti i pixel con bin larghi larghezza
+      (nelle unità dell'immagine), letto a blocchi di righe; errore
+      massimo larghezza/2 rispetto al pixel centrale
+Input:
+    - data = array 2D
+    - bscale, bzero = scala dei valori, default = 1, 0
+    - stima = 'esatta', 'campione' o 'istogramma', default = 'campione'
+    - passo = passo del campione, default = 8
+    - larghezza = larghezza dei bin dell'istogramma, default = 1
+    - righe = righe lette per blocco con 'istogramma', default = 256
+Output:
+    - mediana stimata
+'''
+def mediana(data, bscale = 1., bzero = 0., stima = 'campione', passo = 8, larghezza = 1., righe = 256):
+    if stima == 'esatta':
+        return float(np.median(data))*bscale+bzero
+    campione = np.asarray(data[::passo, ::passo], dtype=np.float64)
+    if stima == 'campione':
+        return float(np.median(campione))*bscale+bzero
+    if stima != 'istogramma':
+        raise ValueError('stima %s non supportata' % stima)
+    passo_bin = larghezza/abs(bscale)                               #larghezza dei bin nei valori grezzi
+    basso, alto = np.percentile(campione, [1, 99])
+    nbin = int(np.ceil((alto-basso)/passo_bin))+1
+    conteggi = np.zeros(nbin, dtype=np.int64)
+    sotto = 0
+    for y0 in range(0, data.shape[0], righe):
+        blocco = np.asarray(data[y0:y0+righe], dtype=np.float64).ravel()
+        indici = np.floor((blocco-basso)/passo_bin).astype(np.int64)
+        sotto += np.count_nonzero(indici < 0)
+        conteggi += np.bincount(indici[(indici >= 0) & (indici < nbin)], minlength=nbin)
+    meta = data.size/2.
+    cumulativa = sotto+np.cumsum(conteggi)
+    if sotto >= meta or cumulativa[-1] < meta:                      #mediana fuori dall'intervallo
+        return mediana(data, bscale, bzero, stima = 'esatta')
+    i = int(np.searchsorted(cumulativa, meta))
+    return (basso+(i+0.5)*passo_bin)*bscale+bzero
+
+############################# NOME_FITS ###############################
+'''
+Aggiunge l'estensione .fits al nome di un'immagine, se manca,
+come fa IRAF con i nomi delle immagini.
+'''
+def nome_fits(nome):
+    if not nome.endswith('.fits'):
+        nome = nome+'.fits'
+    return nome
+
 ############################# OPERATION ###############################
 
 '''
 
 Usa imarith per fare operazioni tra immagini.
+Con engine = 'numpy' legge gli operandi con CARICA e scrive il risultato
+con SCRIVI_FITS; come imarith (divzero = 0) le divisioni per zero danno 0.
+Almeno uno dei due operandi deve essere un'immagine (ValueError).
 Input:
-    - val1 = immagine 1
-    - val2 = immagine 2
+    - val1 = immagine 1, anche con sezione (es. img[1:100,1:100]), o numero
+    - val2 = immagine 2, anche con sezione, o numero
     - operator = tipo di operatore (+,-,/,*)
     - out = immagine di output
+    - pixtype = tipo dei pixel dell'output, default = 'real' (float a 4 byte;
+      con '' imarith usa il tipo più preciso degli input, anche double).
+      Con engine = 'numpy' sono ammessi solo 'real', 'short' e 'ushort'
+      (vedi PIXTYPE): '' scriverebbe in float32 anche input interi o double,
+      quindi è un errore come gli altri tipi
+    - engine = 'iraf' o 'numpy', default = None (vedi IRAF)
     - debug = inutilizzato per ora
 
 '''
 
-def operation(val1, val2, operator, out, debug = False):
-    iraf.imarith(val1, operator, val2, out)
+PIXTYPE = {'real': 'float32', 'short': 'int16', 'ushort': 'uint16'}
+
+def operation(val1, val2, operator, out, pixtype = 'real', engine = None, debug = False):
+    if motore(engine) == 'numpy':
+        if pixtype not in PIXTYPE:
+            raise ValueError('operation: pixtype %r non supportato con engine = numpy' % pixtype)
+        a, header = operando(val1)
+        b, header2 = operando(val2)
+        if header is None:
+            header = header2
+        if header is None:
+            raise ValueError('operation: %s %s %s, serve almeno un\'immagine' % (val1, operator, val2))
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            risultato = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.divide}[operator](a, b)
+        if operator == '/':
+            risultato[np.broadcast_to(np.asarray(b) == 0, risultato.shape)] = 0.
+        header.add_history('imarith: %s %s %s' % (val1, operator, val2))
+        scrivi_fits(nome_fits(out), risultato, header, PIXTYPE[pixtype])
+        return
+    rimuovi(out)
+    TRACCIA.conta_iraf()
+    iraf.imarith(val1, operator, val2, out, pixtype = pixtype)
+
+'''
+Operando di OPERATION: (array, header) per un'immagine, con l'eventuale
+sezione IRAF in fondo al nome; (numero, None) per un numero.
+'''
+def operando(val):
+    try:
+        return float(val), None
+    except ValueError:
+        pass
+    section = None
+    if val.endswith(']') and '[' in val:
+        val, section = val[:val.rindex('[')], val[val.rindex('['):]
+    return carica(val, section)
 
 ############################# ORGANIZZA ###############################
 
 '''
-Organizza i file. La prima volta che viene lanciato crea un file di log.
-Se durante un esecuzione il file di log viene trovato nella cartella 
-i file non vengono spostati. (forse devo trovare un modo migliore)
+Organizza i file nelle cartelle create da CARTELLE. I file già presenti
+nella cartella di destinazione (stessa dimensione) non vengono ricopiati,
+quindi rilanciando la pipeline dopo l'arrivo di nuovi frame vengono
+organizzati solo quelli nuovi.
+Per non duplicare i dati grezzi i file vengono collegati con hardlink
+o symlink invece che copiati (vedi COLLEGA).
 
 Input:
-    - tabella = tabella con i file proveniente da HSEL
+    - tabella = tabella delle osservazioni (vedi TABELLA)
     - main_dir = directory di lavoro, default = './'
+    - modo = 'hardlink', 'symlink' o 'copy', default = 'hardlink'
     - debug = stampa output aggiuntivi, default = False
 Output:
     - filtri = lista con nomi dei filtri utilizzati
     - bias_dir = path della directory dei bias
     - dark_dir = path directory dark
 '''
-def organizza(tabella, main_dir = './', debug = False):
+def organizza(tabella, main_dir = './', modo = 'hardlink', debug = False):
     l = len(tabella['name'])
     filtri, bias_dir, dark_dir = cartelle(tabella, main_dir=main_dir)
-    if not os.path.exists(main_dir+'org.log'):
-        for i in range(l):
-            if tabella['type'][i] == 'Bias':
-                os.system('cp '+main_dir+tabella['name'][i]+'.fits'+' '+main_dir+'bias')
-                if debug: print tabella['name'][i]+'.fits'+' in '+main_dir+'bias'
-            elif tabella['type'][i] == 'Dark':
-                os.system('cp '+main_dir+tabella['name'][i]+'.fits'+' '+main_dir+'dark')
-                if debug: print tabella['name'][i]+'.fits'+' in '+main_dir+'dark'
-            elif tabella['type'][i] == 'Flat':
-                for item in filtri:
-                    if tabella['filter'][i] == item:
-                        os.system('cp '+main_dir+tabella['name'][i]+'.fits'+' '+main_dir+item+'/flats')
-                        if debug: print tabella['name'][i]+'.fits'+' in '+main_dir+item+'/flats'
-            elif tabella['type'][i] == 'Object':
-                for item in filtri:
-                    if tabella['filter'][i] == item:
-                        os.system('cp '+main_dir+tabella['name'][i]+'.fits'+' '+main_dir+item+'/objects')
-                        if debug: print tabella['name'][i]+'.fits'+' in '+main_dir+item+'/objects'   
-        f = open(main_dir+'org.log','w')
-        print >>f, 'The software has already been lunched on this dataset'
-        f.close()
-    else:
-        print 'La ppeline è gia stata usata in questa cartella.'
-        print 'Cancella le vecchie cartelle se la vuoi usare'
-        print 'di nuovo.'
-        print '#############################################'
-        sys.exit()
+    for i in range(l):
+        nome = tabella['name'][i]+'.fits'
+        if tabella['type'][i] == 'Bias':
+            dest = bias_dir
+        elif tabella['type'][i] == 'Dark':
+            dest = dark_dir
+        elif tabella['type'][i] == 'Flat':
+            dest = main_dir+tabella['filter'][i]+'/flats/'
+        elif tabella['type'][i] == 'Object':
+            dest = main_dir+tabella['filter'][i]+'/objects/'
+        else:
+            continue
+        if os.path.exists(dest+nome) and os.path.getsize(dest+nome) == os.path.getsize(main_dir+nome):
+            continue                                                    #già organizzato
+        collega(main_dir+nome, dest+nome, modo = modo)
+        if debug: print nome+' in '+dest
 
     return filtri, bias_dir, dark_dir
 
+############################# PARALLELO ###############################
+'''
+Esegue funzione(*args, **kwargs) per ogni tupla args della lista argomenti.
+Se workers > 1 usa un pool di processi, altrimenti lavora in serie.
+I risultati sono nello stesso ordine degli argomenti, indipendentemente
+dall'ordine in cui finiscono i processi.
+PyRAF tiene in cache i processi IRAF già lanciati, collegati con delle pipe:
+un processo figlio che li eredita li userebbe insieme al padre e agli altri
+figli. Per questo, se IRAF è già caricato, prima di creare il pool il padre
+svuota la cache (flpr, i processi vengono rilanciati quando servono), e
+ogni processo del pool usa una sua cartella uparm temporanea, così i task
+lanciati in parallelo non scrivono gli stessi file dei parametri.
+Input:
+    - funzione = funzione da eseguire, definita a livello di modulo
+    - argomenti = lista di tuple di argomenti
+    - workers = numero di processi, default = 1
+    - kwargs = argomenti passati a tutte le chiamate
+Output:
+    - lista dei risultati
+'''
+def parallelo(funzione, argomenti, workers = 1, **kwargs):
+    argomenti = list(argomenti)
+    if workers <= 1 or len(argomenti) <= 1:
+        return [funzione(*item, **kwargs) for item in argomenti]
+    if iraf.modulo is not None:                                     #i figli non ereditano processi IRAF
+        iraf.flpr()
+    uparm = tempfile.mkdtemp(prefix='uparm')
+    pool = multiprocessing.Pool(min(workers, len(argomenti)), inizia_worker, (uparm,))
+    try:
+        risultati = pool.map(esegui, [(funzione, item, kwargs) for item in argomenti], chunksize = 1)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(uparm, ignore_errors = True)
+    return risultati
+
+def inizia_worker(uparm):
+    iraf.usa_uparm(os.path.join(uparm, str(os.getpid()), ''))
+
+def esegui(task):
+    funzione, args, kwargs = task
+    return funzione(*args, **kwargs)
+
 ############################# PRINT_LIST ###############################
 '''
 
@@ -227,6 +1951,357 @@ def print_list(lista, nomefile, main_dir = './', debug = False):
         print >>f, main_dir+i
     f.close()
 
+############################# PRODOTTI ###############################
+'''
+Grafo dei prodotti della pipeline, salvato su disco in formato JSON.
+Per ogni prodotto (mbias, dark<texp>, mflat<filtro>, *.f.fits finali)
+registra l'impronta (sha1 del contenuto) di ogni file di input e i
+parametri usati. Gli input di un prodotto possono essere a loro volta
+prodotti (es. il masterbias per i dark), così se cambia un master
+diventano vecchi anche tutti i prodotti che ne dipendono.
+Rilanciando la pipeline vengono ricostruiti solo i prodotti mancanti
+o vecchi. Le impronte sono calcolate una volta sola per file e
+ricalcolate solo se cambiano dimensione o mtime.
+CONTIENE dice se un prodotto è stato registrato anche con gli input dati,
+con le stesse impronte: per un prodotto fatto di parti (i piani di un
+CUBO) le parti fatte con quegli input sono ancora buone.
+
+Uso:
+    prodotti = Prodotti(main_dir+'prodotti.json')
+    if not prodotti.aggiornato(out, input, parametri):
+        ... costruisco out ...
+        prodotti.registra(out, input, parametri)
+        prodotti.salva()
+'''
+class Prodotti(object):
+
+    def __init__(self, stato_file):
+        self.stato_file = os.path.abspath(stato_file)
+        self.prodotti = {}
+        self.impronte = {}
+        if os.path.exists(self.stato_file):
+            try:
+                f = open(self.stato_file)
+                stato = json.load(f)
+                f.close()
+                self.prodotti = stato['prodotti']
+                self.impronte = stato['impronte']
+            except (ValueError, KeyError):                          #stato rovinato, si ricostruisce tutto
+                self.prodotti = {}
+                self.impronte = {}
+
+    def impronta(self, nome):
+        path = os.path.abspath(nome_fits(nome))
+        st = os.stat(path)
+        voce = self.impronte.get(path)
+        if voce is None or voce[0] != st.st_size or voce[1] != st.st_mtime:
+            voce = [st.st_size, st.st_mtime, impronta_file(path)]
+            self.impronte[path] = voce
+        return voce[2]
+
+    def aggiornato(self, prodotto, input, parametri):
+        voce = self.prodotti.get(os.path.abspath(nome_fits(prodotto)))
+        if voce is None or not os.path.exists(nome_fits(prodotto)):
+            return False
+        if voce['parametri'] != parametri:
+            return False
+        try:
+            attese = dict((os.path.abspath(nome_fits(item)), self.impronta(item)) for item in input)
+        except OSError:                                             #manca un input
+            return False
+        return voce['input'] == attese
+
+    def contiene(self, prodotto, input, parametri):
+        voce = self.prodotti.get(os.path.abspath(nome_fits(prodotto)))
+        if voce is None or voce['parametri'] != parametri or not os.path.exists(nome_fits(prodotto)):
+            return False
+        try:
+            return all(voce['input'].get(os.path.abspath(nome_fits(item))) == self.impronta(item) for item in input)
+        except OSError:
+            return False
+
+    def registra(self, prodotto, input, parametri):
+        self.prodotti[os.path.abspath(nome_fits(prodotto))] = {'parametri': parametri, \
+                'input': dict((os.path.abspath(nome_fits(item)), self.impronta(item)) for item in input)}
+
+    def salva(self):
+        scrivi_json(self.stato_file, {'prodotti': self.prodotti, 'impronte': self.impronte})
+
+'''
+Impronta di un file: sha1 del contenuto, letto a blocchi da 1 MB.
+'''
+def impronta_file(nome):
+    sha = hashlib.sha1()
+    f = open(nome, 'rb')
+    blocco = f.read(1<<20)
+    while blocco:
+        sha.update(blocco)
+        blocco = f.read(1<<20)
+    f.close()
+    return sha.hexdigest()
+
+'''
+Registra nei PRODOTTI le immagini finali calibrate dai task RIDUCI_FINALE
+della CODA, una volta finiti tutti. Un finale viene registrato solo se è
+quello scritto dai suoi task: ogni RIDUCI_FINALE lascia nel suo task fatto
+il timbro del file che ha prodotto (vedi TIMBRO), e il timbro deve essere
+quello del file attuale. Un finale mancante, o riscritto da una
+generazione diversa dei task, non viene registrato e sarà ricalibrato al
+prossimo giro.
+Input:
+    - stato_file = file dello stato dei prodotti della notte
+    - finali = lista di [immagine finale, lista degli input, parametri, id
+      dei task che lo producono]
+    - anteprime = cartella delle anteprime della notte, di cui aggiornare
+      l'indice, default = None
+    - coda_dir = cartella della coda con i task fatti, default = None
+      (nessun controllo dei timbri)
+'''
+def registra_finali(stato_file, finali, anteprime = None, coda_dir = None):
+    prodotti = Prodotti(stato_file)
+    coda = Coda(coda_dir) if coda_dir is not None else None
+    for finale, input, parametri, ids in finali:
+        if not os.path.exists(finale):
+            continue
+        if coda is not None and ids:
+            attuale = timbro(finale)
+            if any(coda.risultato(id) != attuale for id in ids):    #scritto da un'altra generazione
+                print 'Coda: %s non registrato, timbro diverso' % finale
+                continue
+        prodotti.registra(finale, input, parametri)
+    prodotti.salva()
+    if anteprime is not None:
+        indice_anteprime(anteprime, os.path.dirname(stato_file))
+
+############################## RIDUCI ###################################
+'''
+Riduzione di un singolo frame, usate da PIPELINE come unità di lavoro per
+PARALLELO. Ogni funzione legge e scrive solo i file del proprio frame.
+
+RIDUCI_FRAME: sottrae il masterbias dalla sezione di trimming del frame e
+linearizza (produce *.b, *.l). Il frame grezzo è letto direttamente nella
+sezione, senza scrivere il *.tr, a meno di salva_trim = True.
+Con engine = 'numpy' usa CALIBRA e scrive solo il *.l.
+Input:
+    - image = nome dell'immagine
+    - frame_dir = cartella dell'immagine
+    - mbias = nome del masterbias
+    - trim_section = sezione di trimming
+    - co1, ..., co3 = coefficienti per la linearizzazione
+    - engine = 'iraf' o 'numpy', default = None (vedi IRAF)
+    - salva_trim = scrive anche il frame tagliato *.tr, default = False
+    - lincor = linearizzazione per engine = 'numpy', vedi LINEARIZZA_ARRAY
+    - dati, scrittore = frame già letto e scrittore, solo per engine = 'numpy'
+      (vedi FLUSSO), default = None
+    - formato = formato del *.l (e del *.tr) per engine = 'numpy', vedi
+      SCRIVI_FITS; con IRAF gli intermedi restano in float. default = 'float32'
+    - debug = stampa output aggiuntivi, default = False
+'''
+def riduci_frame(image, frame_dir, mbias, trim_section, co1, co2, co3, engine = None, salva_trim = False, lincor = 'polinomio', \
+        dati = None, scrittore = None, formato = 'float32', debug = False):
+    engine = motore(engine)
+    with TRACCIA.fase('riduci_frame', frame = image, input = [frame_dir+image, mbias], \
+            output = [frame_dir+image+item for item in ('.tr', '.b', '.l')]):
+        op1 = frame_dir+image+trim_section                              #sezione letta direttamente dal grezzo
+        if salva_trim:
+            trim([image], frame_dir, section = trim_section, engine = engine, formato = formato, debug = debug)
+            op1 = frame_dir+image+'.tr'
+        if engine == 'numpy':
+            print '%s - %s -> %s' %(op1, mbias, frame_dir+image+'.l.fits')
+            calibra(frame_dir+image, frame_dir+image+'.l.fits', trim_section, master(mbias), co1 = co1, co2 = co2, co3 = co3, \
+                    lincor = lincor, dati = dati, scrittore = scrittore, formato = formato, debug = debug)
+            return
+        out = frame_dir+image+'.b'
+        print '%s - %s %s' %(op1,mbias,out)
+        operation(op1, mbias, '-', out, engine = engine, debug = debug)
+        linearize(out, frame_dir+image+'.l', co1 = co1, co2 = co2, co3 = co3, engine = engine, debug = debug)
+
+'''
+RIDUCI_FLAT: come RIDUCI_FRAME, poi normalizza il flat dividendolo per la
+sua mediana (produce anche *.n). Con normalizza = False si ferma a *.l,
+per combinare con scale = 'median' (vedi COMBINE_TILES).
+'''
+def riduci_flat(image, flat_dir, mbias, trim_section, co1, co2, co3, normalizza = True, engine = None, salva_trim = False, \
+        lincor = 'polinomio', dati = None, scrittore = None, formato = 'float32', debug = False):
+    riduci_frame(image, flat_dir, mbias, trim_section, co1, co2, co3, engine = engine, salva_trim = salva_trim, lincor = lincor, \
+            dati = dati, scrittore = scrittore, formato = formato, debug = debug)
+    if not normalizza:
+        return
+    with TRACCIA.fase('normalizza', frame = image, input = [flat_dir+image+'.l'], output = [flat_dir+image+'.n']):
+        mediana = stats([image], '.l', flat_dir, engine = engine, debug = debug)[0]
+        op1 = flat_dir+image+'.l'
+        out = flat_dir+image+'.n'
+        print '%s / %i %s' %(op1,mediana,out)
+        operation(op1, mediana, '/', out, engine = engine, debug = debug)
+
+'''
+RIDUCI_OGGETTO: calibrazione completa di un'immagine scientifica fino a *.f.
+Input:
+    - image = nome dell'immagine
+    - obj_dir = cartella dell'immagine
+    - mbias, mdark, mflat = nomi dei master; mdark = None se non c'è un
+      dark per il tempo di esposizione, o [master, scala] per un dark
+      scalato, solo con engine = 'numpy' (vedi DARK)
+    - trim_section = sezione di trimming
+    - co1, ..., co3 = coefficienti per la linearizzazione
+    - engine = 'iraf' (un task per passaggio) o 'numpy' (vedi CALIBRA)
+    - salva_trim = scrive anche il *.tr, solo per engine = 'iraf', default = False
+    - lincor = linearizzazione per engine = 'numpy', vedi LINEARIZZA_ARRAY
+    - dati, scrittore = frame già letto e scrittore, solo per engine = 'numpy'
+      (vedi FLUSSO), default = None
+    - formato = formato del *.f, vedi SCRIVI_FITS; con IRAF il *.f viene
+      convertito alla fine (vedi CONVERTI). default = 'float32'
+    - anteprime = cartella in cui scrivere l'ANTEPRIMA <image>.png, default = None
+    - cubi = dizionario cartella degli oggetti -> CUBO già creato in cui
+      scrivere l'immagine calibrata al posto del *.f, default = None
+    - debug = stampa output aggiuntivi, default = False
+'''
+def riduci_oggetto(image, obj_dir, mbias, mdark, mflat, trim_section, co1, co2, co3, engine = None, salva_trim = False, \
+        lincor = 'polinomio', dati = None, scrittore = None, formato = 'float32', anteprime = None, cubi = None, debug = False):
+    engine = motore(engine)
+    png = None
+    if anteprime is not None:
+        png = anteprime+image+'.png'
+    cubo = None
+    if cubi is not None and obj_dir in cubi:
+        cubo = cubi[obj_dir]
+    scala = 1.
+    if isinstance(mdark, (list, tuple)):                                        #dark scalato, vedi DARK
+        mdark, scala = mdark
+    if scala != 1. and engine != 'numpy':                                       #prima di scrivere *.b e *.l
+        raise ValueError('dark scalato %s x %g: con IRAF va prima scritto su file' % (mdark, scala))
+    with TRACCIA.fase('riduci_oggetto', frame = image, input = [obj_dir+image, mbias, mdark, mflat], \
+            output = [obj_dir+image+'.f'] if cubo is None else []):
+        if engine == 'numpy':
+            out = obj_dir+image+'.f.fits' if cubo is None else piano(cubo, image)
+            print '%s -> %s' %(obj_dir+image, out)
+            dark = None
+            if mdark is not None:
+                dark = dark_scalato(mdark, scala)
+            calibra(obj_dir+image, out, trim_section, master(mbias), dark, master(mflat), co1 = co1, co2 = co2, \
+                    co3 = co3, lincor = lincor, dati = dati, scrittore = scrittore, formato = formato, png = png, debug = debug)
+            return
+        riduci_frame(image, obj_dir, mbias, trim_section, co1, co2, co3, engine = engine, salva_trim = salva_trim, debug = debug)
+        op1 = obj_dir+image+'.l'
+        if mdark is not None:
+            out = obj_dir+image+'.d'
+            print '%s - %s %s' %(op1, mdark, out)
+            operation(op1, mdark, '-', out, engine = engine)                    # Correzione per dark
+            op1 = out
+        out = obj_dir+image+'.f'
+        print '%s / %s %s' %(op1, mflat, out)
+        operation(op1, mflat, '/', out, engine = engine)                        # Correggo per flat
+        if cubo is not None:                                                    #nel cubo, senza tenere il *.f
+            data = carica(out)[0]
+            scrivi_fits(piano(cubo, image), data)
+            rimuovi(out)
+        else:
+            converti(out, formato)
+        if png is not None:
+            anteprima(carica(out)[0] if cubo is None else data, png)
+
+'''
+RIDUCI_TUTTI: lancia una funzione RIDUCI su tutti i frame con workers
+processi. Con engine = 'numpy' ogni processo riduce la sua parte dei frame
+con FLUSSO, leggendo e scrivendo in background; con 'iraf' un task per frame.
+Input:
+    - funzione = RIDUCI_FRAME, RIDUCI_FLAT o RIDUCI_OGGETTO
+    - task = lista delle tuple di argomenti
+    - workers = numero di processi
+    - trim_section = sezione di trimming
+    - memoria = memoria in MB per le code di FLUSSO, divisa tra i processi
+    - kwargs = argomenti aggiuntivi per funzione, compreso engine
+'''
+def riduci_tutti(funzione, task, workers, trim_section, memoria = 512, **kwargs):
+    kwargs['engine'] = motore(kwargs.get('engine'))
+    if kwargs['engine'] != 'numpy':
+        return parallelo(funzione, task, workers, **kwargs)
+    parti = dividi(task, workers)
+    parallelo(flusso, [(funzione, parte, trim_section) for parte in parti], workers, \
+            memoria = memoria/max(1, len(parti)), **kwargs)
+
+'''
+RIDUCI_FINALE: RIDUCI_OGGETTO seguito dallo spostamento dell'immagine
+calibrata in final/, task per la CODA. Il rename rende l'output idempotente:
+final/ contiene solo immagini complete, anche se il task viene rieseguito.
+Con un CUBO (kwargs cubi) l'immagine è già nel suo piano, non c'è niente
+da spostare; se il cubo non è più della generazione del task (ricreato
+dopo che il task è stato messo in coda) il task non fa niente.
+Gli intermedi non in conserva vengono cancellati (vedi PULISCI).
+Output:
+    - timbro del finale scritto (vedi TIMBRO), che la CODA salva nel task
+      fatto per REGISTRA_FINALI; None se il task non ha scritto niente
+'''
+def riduci_finale(image, obj_dir, mbias, mdark, mflat, trim_section, co1, co2, co3, conserva = None, generazione = None, **kwargs):
+    cubo = (kwargs.get('cubi') or {}).get(obj_dir)
+    if cubo is not None and generazione_cubo(cubo) != generazione:
+        print '%s: cubo ricreato, salto %s' % (cubo, image)
+        return None
+    riduci_oggetto(image, obj_dir, mbias, mdark, mflat, trim_section, co1, co2, co3, **kwargs)
+    pulisci(obj_dir, [image], conserva)
+    if cubo is not None:
+        return generazione
+    finale = obj_dir+'final/'+image+'.f.fits'
+    os.rename(obj_dir+image+'.f.fits', finale)
+    return timbro(finale)
+
+'''
+Timbro di un finale, per REGISTRA_FINALI: la generazione per un CUBO,
+l'impronta del contenuto per un'immagine.
+'''
+def timbro(finale):
+    return generazione_cubo(finale) or impronta_file(finale)
+
+############################## RIMUOVI ###################################
+'''
+Cancella un'immagine se esiste. I task IRAF non sovrascrivono le immagini,
+quindi va chiamata prima di ricostruire un prodotto già presente.
+Input:
+    - nome = nome dell'immagine, con o senza .fits
+'''
+def rimuovi(nome):
+    if os.path.exists(nome_fits(nome)):
+        os.remove(nome_fits(nome))
+
+'''
+Politica di conservazione dei prodotti intermedi: cancella i *.tr, *.b,
+*.l, *.d e *.n delle immagini, tranne i tipi elencati in conserva.
+Va chiamata quando i prodotti che ne dipendono (master, finali) sono
+pronti; se servono di nuovo la pipeline li ricostruisce.
+Input:
+    - cartella = cartella delle immagini
+    - immagini = lista dei nomi delle immagini
+    - conserva = intermedi da tenere, es. ['l'] o [] per nessuno;
+      None tiene tutto, default = None
+'''
+INTERMEDI = ('tr', 'b', 'l', 'd', 'n')
+
+def pulisci(cartella, immagini, conserva = None):
+    if conserva is None:
+        return
+    for item in immagini:
+        for tipo in INTERMEDI:
+            if tipo not in conserva:
+                rimuovi(cartella+item+'.'+tipo)
+
+############################ SCRIVI_JSON #################################
+'''
+Scrive un oggetto in un file JSON in modo atomico: prima in un file
+temporaneo nella stessa cartella, poi con un rename, così un'interruzione
+non lascia mai un file a metà.
+Input:
+    - nome = nome del file
+    - oggetto = oggetto da salvare
+    - indent = indentazione del JSON, default = None (una riga)
+'''
+def scrivi_json(nome, oggetto, indent = None):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(nome)))
+    f = os.fdopen(fd, 'w')
+    json.dump(oggetto, f, indent=indent)
+    f.close()
+    os.chmod(tmp, 0644)                                             #mkstemp crea il file con 0600
+    os.rename(tmp, nome)
+
 ############################## SEPARA ###################################
 '''
 Crea lista di file a partire dalla lista delle osservazioni.  
@@ -240,6 +2315,8 @@ Output:
 '''
 ## crea liste di files a partire dalla lista delle osservazioni.
 def separa(lista, field, value, debug=False):
+    if isinstance(lista, Tabella):                                      #ricerca sull'indice
+        return list(lista.group_by(**{field: value}))
     output = []
     for i in range(len(lista[field])):
         if debug:
@@ -248,42 +2325,324 @@ def separa(lista, field, value, debug=False):
             output.append(lista['name'][i])
     return output
 
+############################## SEZIONE ###################################
+'''
+Converte una sezione in formato IRAF ('[x1:x2,y1:y2]', pixel contati da 1
+ed estremi inclusi) negli slice numpy corrispondenti. '*' indica l'asse intero.
+Input:
+    - section = sezione come per imcopy
+Output:
+    - (righe, colonne) = tupla di slice da usare su un array numpy
+'''
+def sezione(section):
+    assi = []
+    for item in section.strip().strip('[]').split(','):
+        if item.strip() == '*':
+            assi.append(slice(None))
+        else:
+            a, b = item.split(':')
+            assi.append(slice(int(a)-1, int(b)))
+    return assi[1], assi[0]
+
+'''
+Aggiorna l'header di un'immagine letta con section come fa imcopy: CRPIXn
+sono spostati dell'origine della sezione e LTVn/LTMn_n riportano le
+coordinate fisiche a quelle del frame intero.
+Input:
+    - header = header da modificare (sul posto)
+    - section = sezione come per imcopy
+'''
+def sposta_header(header, section):
+    righe, colonne = sezione(section)
+    for n, asse in ((1, colonne), (2, righe)):
+        inizio = asse.start or 0
+        if not inizio:
+            continue
+        if 'CRPIX%d' % n in header:
+            header['CRPIX%d' % n] -= inizio
+        header['LTV%d' % n] = header.get('LTV%d' % n, 0.) - inizio
+        header['LTM%d_%d' % (n, n)] = header.get('LTM%d_%d' % (n, n), 1.)
+
 ############################## STATS #####################################
 '''
 Usa imstat per fare statistica sulle immagini.
+Con engine = 'numpy' calcola la statistica con numpy: midpt e median sono
+la mediana esatta, stddev ha n-1 al denominatore come imstat.
 Input:
     - lista = lista di immagini da analizzare
     - extension = estensione del file da analizzare
     - main_dir = directory di lavoro, default = './'
-    - field = valore statistico ricercato
+    - field = valore statistico ricercato (midpt, median, mean, stddev,
+      min, max, npix)
+    - engine = 'iraf' o 'numpy', default = None (vedi IRAF)
     - debug = non utilizzato
 output:
     - out2 = statistica richiesta
 '''
-def stats(lista, extension, main_dir = './', field = 'midpt', debug = False):
+STATISTICHE = {'midpt': np.median, 'median': np.median, 'mean': np.mean, 'stddev': lambda x: np.std(x, ddof=1), \
+        'min': np.min, 'max': np.max, 'npix': np.size}
+
+def stats(lista, extension, main_dir = './', field = 'midpt', engine = None, debug = False):
+    if motore(engine) == 'numpy':
+        out2 = []
+        for item in lista:
+            data = carica(main_dir+item+extension)[0]
+            out2.append(STATISTICHE[field](data[np.isfinite(data)]))
+        return np.array(out2, dtype='d')
     out= []
     out2 = []
     for item in lista:
+        TRACCIA.conta_iraf()
         out.append(iraf.imstat(main_dir+item+extension, fields = field, Stdout=1))
     for i in range(len(out)):
         out2.append(out[i][1])
     out2=np.array(out2, dtype='d')
     return out2
 
+############################## TABELLA ###################################
+'''
+Tabella delle osservazioni con indici su tipo, filtro, tempo di esposizione
+e oggetto. Si costruisce una volta sola a partire dall'output di HSEL e poi
+si interroga senza più leggere header né scorrere tutta la tabella.
+
+Uso:
+    obs = Tabella(hsel(main_dir+'*.fits'))
+    obs['name']                                    #colonna, come per HSEL
+    obs.valori('filter')                           #valori distinti, in ordine di apparizione
+    obs.group_by(type='Flat', filter='R')          #nomi dei file che soddisfano i criteri
+    obs.seleziona(type='Dark')                     #sotto-tabella, anche lei indicizzata
+'''
+class Tabella(object):
+
+    campi = ('type', 'filter', 'texp', 'obj')
+
+    def __init__(self, dati):
+        self.dati = np.atleast_1d(dati)
+        self.indici = {}
+        self.ordine = {}
+        for campo in self.campi:
+            indice = {}
+            ordine = []
+            for i, valore in enumerate(self.dati[campo]):
+                if valore not in indice:
+                    indice[valore] = []
+                    ordine.append(valore)
+                indice[valore].append(i)
+            self.indici[campo] = dict((k, np.array(v)) for k, v in indice.items())
+            self.ordine[campo] = ordine
+
+    def __getitem__(self, campo):
+        return self.dati[campo]
+
+    def __len__(self):
+        return len(self.dati)
+
+    def valori(self, campo, **criteri):
+        if not criteri:
+            return list(self.ordine[campo])
+        return self.seleziona(**criteri).valori(campo)
+
+    def righe(self, **criteri):
+        righe = None
+        for campo, valore in criteri.items():
+            trovate = self.indici[campo].get(valore, np.array([], dtype=int))
+            if righe is None:
+                righe = trovate
+            else:
+                righe = np.intersect1d(righe, trovate)
+        if righe is None:
+            return np.arange(len(self.dati))
+        return np.sort(righe)
+
+    def seleziona(self, **criteri):
+        return Tabella(self.dati[self.righe(**criteri)])
+
+    def group_by(self, **criteri):
+        return self.dati['name'][self.righe(**criteri)]
+
+############################## TRACCIA ###################################
+'''
+Strumentazione della pipeline. Per ogni fase (organizzazione, masterbias,
+dark, flat, oggetti) e per ogni frame registra:
+    - durata (tempo reale) e tempo di CPU del processo, compresi i processi
+      di PARALLELO terminati durante la fase
+    - byte letti e scritti: dimensione dei file di input e di output della
+      fase, e I/O del processo da /proc/self/io (rchar, wchar)
+    - numero di task IRAF lanciati dal processo
+Ogni evento è una riga JSON aggiunta al file della traccia, quindi anche i
+processi di PARALLELO scrivono nella stessa traccia. Alla fine RIEPILOGO
+stampa una tabella per fase e CHROME esporta la traccia nel formato di
+chrome://tracing (o ui.perfetto.dev) per una vista a fiamma.
+Con la traccia chiusa (default) le fasi non misurano niente.
+
+Uso:
+    TRACCIA.apri(main_dir+'traccia.jsonl')
+    with TRACCIA.fase('riduci_frame', frame = image, input = [...], output = [...]):
+        ...
+    f = TRACCIA.fase('dark')
+    ...
+    f.chiudi()
+    TRACCIA.riepilogo()
+    TRACCIA.chrome(main_dir+'traccia.json')
+    TRACCIA.chiudi()
+CHIUDI chiude le fasi rimaste aperte (con errore = True dopo un'eccezione)
+e la traccia: le fasi successive non misurano più niente.
+'''
+class Traccia(object):
+
+    def __init__(self):
+        self.file = None
+        self.iraf = 0
+        self.aperte = []
+
+    def apri(self, nome):
+        self.file = os.path.abspath(nome)
+        self.aperte = []
+        open(self.file, 'w').close()
+
+    def chiudi(self, errore = False):
+        for item in reversed(self.aperte):                              #dalla più interna
+            item.chiudi(errore = errore)
+        self.file = None
+
+    def conta_iraf(self):
+        self.iraf += 1
+
+    def fase(self, nome, frame = None, input = (), output = ()):
+        return Fase(self, nome, frame, input, output)
+
+    def scrivi(self, evento):
+        fd = os.open(self.file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+        os.write(fd, json.dumps(evento)+'\n')                           #una sola write: righe intere anche in parallelo
+        os.close(fd)
+
+    def eventi(self):
+        f = open(self.file)
+        eventi = [json.loads(item) for item in f if item.strip()]
+        f.close()
+        return eventi
+
+    def riepilogo(self):
+        if self.file is None:
+            return
+        righe = {}
+        ordine = []
+        for e in self.eventi():
+            if e['nome'] not in righe:
+                righe[e['nome']] = dict(n = 0, durata = 0., cpu = 0., letti = 0, scritti = 0, iraf = 0)
+                ordine.append(e['nome'])
+            r = righe[e['nome']]
+            r['n'] += 1
+            r['durata'] += e['durata']
+            r['cpu'] += e['cpu']
+            r['letti'] += e['byte_letti']
+            r['scritti'] += e['byte_scritti']
+            r['iraf'] += e['iraf']
+        print '%-16s %6s %10s %10s %12s %12s %6s' % ('fase', 'n', 'tempo [s]', 'cpu [s]', 'letti [MB]', 'scritti [MB]', 'iraf')
+        for nome in ordine:
+            r = righe[nome]
+            print '%-16s %6i %10.2f %10.2f %12.1f %12.1f %6i' % (nome, r['n'], r['durata'], r['cpu'], \
+                    r['letti']/1024.**2, r['scritti']/1024.**2, r['iraf'])
+
+    def chrome(self, nome):
+        eventi = []
+        for e in self.eventi():
+            eventi.append({'name': e['nome'], 'ph': 'X', 'pid': e['pid'], 'tid': e['pid'], \
+                    'ts': e['inizio']*1e6, 'dur': e['durata']*1e6, 'args': e})
+        f = open(nome, 'w')
+        json.dump({'traceEvents': eventi, 'displayTimeUnit': 'ms'}, f)
+        f.close()
+
+class Fase(object):
+
+    def __init__(self, traccia, nome, frame, input, output):
+        self.traccia = traccia
+        self.attiva = traccia.file is not None
+        if not self.attiva:
+            return
+        self.nome, self.frame, self.output = nome, frame, output
+        traccia.aperte.append(self)
+        self.letti = dimensione(input)
+        self.iraf = traccia.iraf
+        self.io = io_processo()
+        self.cpu = os.times()
+        self.inizio = time.time()
+
+    def chiudi(self, errore = False):
+        if not self.attiva:
+            return
+        self.attiva = False
+        if self in self.traccia.aperte:
+            self.traccia.aperte.remove(self)
+        durata = time.time()-self.inizio
+        cpu = os.times()
+        io = io_processo()
+        self.traccia.scrivi({'nome': self.nome, 'frame': self.frame, 'pid': os.getpid(), \
+                'inizio': self.inizio, 'durata': durata, 'cpu': sum(cpu[:4])-sum(self.cpu[:4]), \
+                'byte_letti': self.letti, 'byte_scritti': dimensione(self.output), \
+                'io_letti': io[0]-self.io[0], 'io_scritti': io[1]-self.io[1], \
+                'iraf': self.traccia.iraf-self.iraf, 'errore': errore})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, valore, tb):
+        self.chiudi(errore = tipo is not None)
+        return False
+
+TRACCIA = Traccia()
+
+'''
+Dimensione totale in byte delle immagini esistenti nella lista.
+'''
+def dimensione(nomi):
+    totale = 0
+    for item in nomi:
+        if item is not None and os.path.exists(nome_fits(item)):
+            totale += os.path.getsize(nome_fits(item))
+    return totale
+
+'''
+Byte letti e scritti dal processo (rchar, wchar da /proc/self/io),
+(0, 0) se non disponibile.
+'''
+def io_processo():
+    try:
+        f = open('/proc/self/io')
+        valori = dict(item.split(':') for item in f)
+        f.close()
+        return int(valori['rchar']), int(valori['wchar'])
+    except (IOError, KeyError, ValueError):
+        return 0, 0
+
 ############################## TRIM #######################################
 
 '''
-Usa imcopy per tagliare le immagini.
+Usa imcopy per tagliare le immagini, scrivendo i *.tr.
+La pipeline non ne ha bisogno: COMBINE e RIDUCI leggono direttamente la
+sezione del frame grezzo. Serve solo se si vogliono i frame tagliati su disco.
 Input:
     - lista = lista delle immagini da trimmare
     - main_dir = directory di lavoro, default = './'
     - section = sezione dell'immagine per il trimming
+    - engine = 'iraf' usa imcopy, 'numpy' legge la sezione dal memmap
+      (vedi CARICA), default = 'iraf'
+    - formato = formato di output per engine = 'numpy', vedi SCRIVI_FITS;
+      'uint16' è senza perdite per i frame grezzi, default = 'float32'
     - debug = non utilizzato
 '''
-def trim(lista, main_dir = './', section ='[100:3996,100:3996]', debug=False):
+def trim(lista, main_dir = './', section ='[100:3996,100:3996]', engine = None, formato = 'float32', debug=False):
+    engine = motore(engine)
     for i in lista: 
         obj = main_dir+'%s%s' % (i, section)
         out = main_dir+'%s.tr.fits' % i
+        if engine == 'numpy':
+            data, header = carica(main_dir+i, section)
+            header.add_history('trim: %s' % section)
+            scrivi_fits(out, data, header, formato)
+            continue
+        rimuovi(out)
+        TRACCIA.conta_iraf()
         iraf.imcopy(obj,output=out)
 
 ############################ PIPELINE #####################################
@@ -294,7 +2653,8 @@ Codice principale della pipeline. E' scritto come una funzione, in modo che
 sia possibile usarlo in modo un po' più elastico e ordinato.
 
 Funzionamento:
-1. Il programma crea una lista temporanea dei file fits nella cartella,
+1. Il programma legge gli header dei file fits nella cartella (tenuti nel
+   catalogo catalogo_header.json, vedi CATALOGO) ed
    estrae le informazioni importanti:
     -nome file
     -target
@@ -303,13 +2663,21 @@ Funzionamento:
     -tempo di esposizione
     -airmass
 
-2. Crea delle cartelle per bias e dark e copia quei file all'interno delle suddette cartelle.
+2. Crea delle cartelle per bias e dark e vi collega quei file (hardlink, senza copiarli).
 3. Controla anche tutti i filtri utilizzati durante la notte e divide flats e immagini scientifiche 
    in cartelle in base ai filtri utilizzati.
-4. Taglia i bias e crea il masterbias
-5. Taglia i dark, li corregge per bias, li linearizza e combina creando il master_bias
-6. per ogni filtro taglia i flat, li corregge per bias, li linearizza, normalizza e combina creando il masterflat
+4. Crea il masterbias combinando la sezione di trimming dei bias
+5. Corregge per bias la sezione di trimming dei dark, li linearizza e combina creando i master dark
+6. per ogni filtro corregge i flat per bias, li linearizza, normalizza e combina creando il masterflat
 7. Idem come sopra per i target, ma corregge anche per dark e per flat.
+   La sezione di trimming viene letta direttamente dai frame grezzi: i *.tr
+   non vengono scritti, a meno di salva_trim = True.
+8. Se la pipeline viene rilanciata nella stessa cartella (dopo un'interruzione
+   o dopo l'arrivo di nuovi frame) ricostruisce solo i prodotti che mancano
+   o i cui input o parametri sono cambiati (trim_section, co, engine, lincor,
+   formato, combinazione, e formato_finale per le immagini finali). Lo stato
+   è in prodotti.json; le immagini finali vengono registrate a blocchi,
+   quindi dopo un'interruzione non si rifanno quelle già finite.
 
 Input:
     - main_dir = directory di lavoro non c'è default qui.
@@ -318,245 +2686,788 @@ Input:
       default = CCD nuovo schmidt 
       CCD nuovo = [1., -0.10140076, 0.034650755]
       SBIG = [1., 0., 0.0133]
+    - engine = 'iraf' calibra gli oggetti con i task IRAF, un file per ogni passaggio;
+      'numpy' li calibra in memoria in un solo passaggio (vedi CALIBRA)
+      e scrive solo i *.f.fits, e combina i master con COMBINE_TILES; non
+      serve IRAF. default = None, vedi IRAF
+    - lincor = linearizzazione con engine = 'numpy': 'polinomio' o 'tabella'
+      (vedi LINEARIZZA_ARRAY). default = 'polinomio'
+    - coda = cartella di una CODA condivisa: la calibrazione degli oggetti
+      viene messa in coda, un task per immagine, invece di essere eseguita
+      qui; le immagini vengono registrate nei prodotti quando sono finite
+      tutte. default = None
+    - formato = formato dei prodotti intermedi scritti con engine = 'numpy'
+      (*.l di dark e flat, *.tr), vedi SCRIVI_FITS; non compresso, perché
+      vengono combinati, e non 'uint16', perché dopo la sottrazione del
+      bias hanno anche valori negativi. default = 'float32'
+    - formato_finale = formato delle immagini in final/, es. 'rice' per la
+      compressione a tile. default = 'float32'
+    - cubo = le immagini calibrate di ogni filtro vanno in un solo CUBO
+      final/cubo<filtro>.fits, con l'indice delle immagini, invece che in un
+      *.f.fits per immagine (formato_finale non si applica, il cubo è in
+      float32). Se cambiano le immagini del filtro il cubo viene ricreato:
+      vengono calibrate solo le immagini nuove o cambiate, i piani delle
+      altre vengono copiati dal cubo vecchio (vedi CUBO). default = False
+    - conserva = intermedi da tenere quando master e finali sono pronti,
+      es. [] per cancellarli tutti o ['l'] (vedi PULISCI). default = None, tutti
+    - memoria_io = con engine = 'numpy' i frame vengono letti in anticipo e
+      scritti in background (vedi FLUSSO); memoria massima in MB per i frame
+      in coda. default = 512
+    - workers = numero di processi per le riduzioni dei singoli frame e per le
+      combinazioni dei master indipendenti (vedi PARALLELO). Ogni fase parte solo
+      quando la precedente è finita: masterbias, dark, flat, oggetti. default = 1
+    - libreria = cartella della libreria dei master (vedi LIBRERIA). Se c'è un
+      master compatibile entro validita giorni viene usato quello invece di
+      combinare i frame della notte, anche per notti senza dark o flat;
+      i master costruiti vengono aggiunti alla libreria. default = None
+    - validita = finestra di validità dei master in libreria, in giorni. default = 30
+    - organizzazione = come mettere i file grezzi nelle cartelle: 'hardlink',
+      'symlink' o 'copy' (vedi ORGANIZZA). default = 'hardlink'
+    - files = file da ridurre, come per HSEL. default = main_dir+'*.fits'
+    - interattivo = chiede conferma dopo l'organizzazione dei file. default = True
+    - display = mostra i master su DS9, solo per uso interattivo. default = False
+    - anteprime = scrive le anteprime PNG dei master e delle immagini finali
+      in main_dir/anteprime/, con un indice index.html (vedi ANTEPRIMA).
+      default = True
+    - salva_trim = scrive anche i frame tagliati *.tr. default = False
+    - tolleranza_dark = differenza relativa massima tra il tempo di
+      esposizione di un'immagine e quello del suo master dark (vedi DARK).
+      default = 0.01
+    - scala_dark = le immagini senza un master dark con il loro tempo di
+      esposizione vengono corrette con un master scalato (vedi DARK);
+      con False restano senza correzione per dark. default = True
+    - combinazione = parametri di COMBINE per i master (comb, rej, low, high,
+      max_mem, stima), es. {'comb': 'average', 'low': 2, 'high': 2}.
+      default = None, quelli di COMBINE
+    - traccia = file JSON-lines in cui registrare tempi, CPU, byte letti e scritti
+      e task IRAF di ogni fase e di ogni frame, con un riepilogo finale
+      (vedi TRACCIA). default = None, nessuna misura
+    - chrome = file in cui esportare la traccia per chrome://tracing, solo
+      con traccia. default = None
 Output:
     Gli output sono tutti files:
         - mbias.fits = masterbias
         - dark*.fits = master dark per i diversi tempi di esposizione
         - mflat*.fits = master flats per ogni filtro
+        - *.tr.fits = file tagliati, solo con salva_trim
         - *.b.fits = file corretti per bias
         - *.l.fits = file linearizzati
         - *.d.fits = file corretti per dark
         - *.f.fits = file corretti per flat
         - *.n.fits = flat normalizzati
+        - final/cubo*.fits = cubi delle immagini calibrate, solo con cubo
+        - prodotti.json = stato dei prodotti (vedi PRODOTTI)
+        - anteprime/*.png, anteprime/index.html = anteprime
+    Restituisce l'esito: 'ok', 'in coda' se la calibrazione degli oggetti
+    è stata messa nella CODA, 'nessun bias' se non c'è niente da calibrare
+    (nessun bias né masterbias per la notte).
         
 '''
 
 #pipeline
-def pipeline(main_dir, trim_section, co1 = 1, co2 = -0.10140076, co3 = 0.034650755, debug = False):                                                      
-    obs_list = hsel(main_dir+'*.fits', main_dir=main_dir, debug = debug)             #creo tabella con i file e i dati delle immagini
-
-
-    print '############ Organizing ##############'                          
+def pipeline(main_dir, trim_section, co1 = 1, co2 = -0.10140076, co3 = 0.034650755, engine = None, workers = 1, libreria = None, validita = 30, organizzazione = 'hardlink', \
+        files = None, interattivo = True, display = False, anteprime = True, salva_trim = False, lincor = 'polinomio', formato = 'float32', \
+        formato_finale = 'float32', conserva = None, memoria_io = 512, coda = None, combinazione = None, cubo = False, \
+        tolleranza_dark = 0.01, scala_dark = True, traccia = None, chrome = None, debug = False):
+    engine = motore(engine)
+    combinazione = dict(combinazione or {})
+    for item in combinazione:
+        if item not in ('comb', 'rej', 'low', 'high', 'max_mem', 'stima'):
+            raise ValueError('combinazione: parametro %s non valido' % item)
+    if formato.partition(':')[0] in COMPRESSI:                                  #gli intermedi vanno in COMBINE_TILES
+        raise ValueError('formato %s: gli intermedi non possono essere compressi' % formato)
+    if formato == 'uint16':                                                     #*.l con bias sottratto: anche negativi
+        raise ValueError('formato uint16: gli intermedi hanno valori negativi')
+    if traccia is not None:
+        TRACCIA.apri(traccia)
+    try:
+        cache = main_dir+'catalogo_header.json'                                   #catalogo degli header della notte
+        if files is None:
+            files = main_dir+'*.fits'
+        with TRACCIA.fase('catalogo'):
+            obs_list = Tabella(hsel(files, main_dir=main_dir, cache = cache, debug = debug))  #creo tabella con i file e i dati delle immagini
+
+
+        print '############ Organizing ##############'                          
 
-    '''
-    Organizzo i file e mi tiro fuori la lista dei filtri
-    e le cartelle di dark e bias. Chiedo un input in modo che 
-    l'utente possa controllare se tutto ok.
+        '''
+        Organizzo i file e mi tiro fuori la lista dei filtri
+        e le cartelle di dark e bias. Chiedo un input in modo che 
+        l'utente possa controllare se tutto ok.
 
-    '''
-    filtri, bias_dir, dark_dir = organizza(obs_list, \
-            main_dir= main_dir, debug = debug)                             
+        '''
+        with TRACCIA.fase('organizza'):
+            filtri, bias_dir, dark_dir = organizza(obs_list, \
+                    main_dir= main_dir, modo = organizzazione, debug = debug)                             
 
-    question = raw_input('Continue? y/n ')
-    if question not in ['y','Y','yes','Yes']:
-        sys.exit()
+        if interattivo:
+            question = raw_input('Continue? y/n ')
+            if question not in ['y','Y','yes','Yes']:
+                sys.exit()
 
 
-    print '############ Master Bias #############'
-    '''
-    Creazione del masterbias. 
+        print '############ Master Bias #############'
+        '''
+        Creazione del masterbias. 
     
-    Prima seleziono i bias dalla lista
-    delle osservazioni, poi effettuo il trimming alla selezione 
-    definita, li combino e li mostro su DS9
-    '''
-
-    bias = separa(obs_list,'type','Bias', debug = debug)                    
-
-    trim(bias, bias_dir, section = trim_section)                                                    
-
-    combine(bias, '.tr', 'mbias', bias_dir, debug = debug)                    
-    iraf.display(bias_dir+'mbias.fits',frame = 1)            
-
-    print '############ Dark #############'
-
-    '''
-    Creazione dei master dark.
-
-    Seleziono i dark dalla lista delle osservazioni, li stampo 
-    in una lista su file da dare in paste a IRAF e li taglio. 
-    Eseguo la correzione per bias e linearizzo tutte le immagini.
-
-    '''
-
-    dark = separa(obs_list,'type','Dark', debug = debug)                        
-    trim(dark, dark_dir, section = trim_section, debug = debug)  
-    print_list(dark, 'dark', main_dir = dark_dir, debug = debug)
-    dark_list = hsel('@'+dark_dir+'dark', main_dir=dark_dir, debug = debug)                                   
-
-    for item in dark_list['name']:
-        operation(dark_dir+item+'.tr', bias_dir+'mbias.fits', '-', dark_dir+item+'.b', debug = debug)              
-        linearize(dark_dir+item+'.b', dark_dir+item+'.l', debug = debug)
-
-    '''
-    individuo il numero di dark diversi effettuati, in base al
-    tempo di esposizione. Combino poi solo i dark che hanno lo stesso
-    tempo di esposizione. 
-    '''
-
-    exptime=[]
-    for time in dark_list['texp']:                                            #controllo numero dark
-        if time not in exptime:
-            exptime.append(time)
-    exptime=np.array(exptime)
-
-    for time in exptime:                                                    
-        lista_temp=[]
-        for i in range(len(dark_list['texp'])):
-            if dark_list['texp'][i]==time:                                    #seleziono i dark da combinare
-                lista_temp.append(dark_list['name'][i])                
-
-        out = 'dark%s.fits' % str(time)                                            #nomino il nuovo file
-        if debug: print out
-        combine(lista_temp, '.l', out, dark_dir, debug = debug)                #combino
-        iraf.display(dark_dir+out,frame = 1)                                            #mostro
-
-    os.remove(dark_dir+'dark')                                                #elimino la lista dei dark
+        Prima seleziono i bias dalla lista
+        delle osservazioni, poi effettuo il trimming alla selezione 
+        definita, li combino e li mostro su DS9.
+        Ogni master e ogni immagine finale viene ricostruito solo se
+        manca o se sono cambiati i suoi input o i parametri (vedi PRODOTTI).
+        '''
 
+        prodotti = Prodotti(main_dir+'prodotti.json')
+        parametri = {'trim_section': trim_section, 'co': [co1, co2, co3], 'engine': engine, 'lincor': lincor, 'formato': formato}
+        if combinazione:                                                        #i master cambiano con la combinazione
+            parametri['combinazione'] = combinazione
+
+        lib = None
+        if libreria is not None:
+            lib = Libreria(libreria)
+            data, binning = descrivi_notte([main_dir+item for item in obs_list['name']], cache)
+            print 'Notte %s, binning %s, libreria %s' % (data, binning, lib.lib_dir)
+
+        fase = TRACCIA.fase('bias')
+        bias = obs_list.group_by(type = 'Bias')
+        mbias = bias_dir+'mbias.fits'
+        input_bias = [bias_dir+item for item in bias]
+        trovato = None
+        if lib is not None:
+            trovato = lib.cerca('bias', data, binning, trim_section, validita)
+        if len(bias) == 0 and trovato is None and not os.path.exists(mbias):
+            print 'Nessun bias: niente da calibrare per ora'
+            fase.chiudi()
+            fine_traccia(chrome)
+            return 'nessun bias'
+
+        dir_anteprime = None
+        galleria = None
+        if anteprime:                                                           #anteprime in background
+            dir_anteprime = os.path.join(os.path.abspath(main_dir), 'anteprime', '')
+            galleria = Anteprime(dir_anteprime, titolo = os.path.abspath(main_dir))
+
+        if serve_master(mbias, input_bias, trovato, prodotti, parametri):
+            if salva_trim:
+                parallelo(trim, [([item], bias_dir) for item in bias], workers, section = trim_section, engine = engine, formato = formato)
+                combine(bias, '.tr', 'mbias', bias_dir, engine = engine, debug = debug, **combinazione)
+                pulisci(bias_dir, bias, conserva)
+            else:
+                combine(bias, '', 'mbias', bias_dir, engine = engine, section = trim_section, debug = debug, **combinazione)
+            if display:
+                TRACCIA.conta_iraf()
+                iraf.display(mbias,frame = 1)            
+            if galleria is not None:
+                galleria.aggiungi(mbias, 'mbias')
+            prodotti.registra(mbias, input_bias, parametri)
+            prodotti.salva()
+            if lib is not None:
+                lib.pubblica(mbias, 'bias', data, binning, trim_section)
+        fase.chiudi()
+
+        print '############ Dark #############'
 
+        '''
+        Creazione dei master dark.
 
-    print '############ Flat ############'
+        Individuo i dark diversi effettuati, in base al tempo di esposizione.
+        Per i master da ricostruire taglio, correggo per bias e linearizzo
+        tutte le immagini, un processo per immagine, poi combino solo i dark
+        che hanno lo stesso tempo di esposizione.
 
-    '''
-    Creazione dei masterflat.
+        '''
 
-    Seleziono i flat dalla lista delle osservazioni.
-    Per ogni filtro creo una variabile con il path della cartella dei
-    flat. Correggo ogni immagine per bias e linearizzo. Bias 
-    e flat stanno in cartelle diverse.
-    '''
+        fase = TRACCIA.fase('dark')
+        exptime = obs_list.valori('texp', type = 'Dark')                          #tempi di esposizione dei dark
+
+        lib_dark = {}
+        if lib is not None:                                                     #dark in libreria, anche per i tempi degli oggetti
+            for time in exptime+[item for item in obs_list.valori('texp', type = 'Object') if item not in exptime]:
+                trovato = lib.cerca('dark', data, binning, trim_section, validita, texp = time, co = [co1, co2, co3])
+                if trovato is not None:
+                    lib_dark[time] = trovato
+                    if time not in exptime:
+                        exptime.append(time)
+
+        da_fare = []
+        input_dark = {}
+        for time in exptime:
+            out = 'dark%s.fits' % str(time)                                            #nomino il nuovo file
+            input_dark[out] = [dark_dir+item for item in obs_list.group_by(type = 'Dark', texp = time)]+[mbias]
+            if serve_master(dark_dir+out, input_dark[out], lib_dark.get(time), prodotti, parametri):
+                da_fare.append(time)
+
+        riduci_tutti(riduci_frame, [(item, dark_dir, mbias, trim_section, co1, co2, co3) \
+                for time in da_fare for item in obs_list.group_by(type = 'Dark', texp = time)], workers, trim_section, memoria_io, \
+                engine = engine, salva_trim = salva_trim, lincor = lincor, formato = formato, debug = debug)
+
+        task = []
+        for time in da_fare:
+            out = 'dark%s.fits' % str(time)
+            if debug: print out
+            task.append((obs_list.group_by(type = 'Dark', texp = time), '.l', out, dark_dir))
+        parallelo(combine, task, workers, engine = engine, debug = debug, **combinazione)           #combino
+        for time in da_fare:
+            out = 'dark%s.fits' % str(time)
+            if display:
+                TRACCIA.conta_iraf()
+                iraf.display(dark_dir+out,frame = 1)                                #mostro
+            if galleria is not None:
+                galleria.aggiungi(dark_dir+out, out[:-len('.fits')])
+            prodotti.registra(dark_dir+out, input_dark[out], parametri)
+            pulisci(dark_dir, obs_list.group_by(type = 'Dark', texp = time), conserva)
+            if lib is not None:
+                lib.pubblica(dark_dir+out, 'dark', data, binning, trim_section, texp = float(time), co = [co1, co2, co3])
+        prodotti.salva()
+        fase.chiudi()
+
+
+
+        print '############ Flat ############'
 
-    flat = separa(obs_list,'type','Flat', debug = debug)                    #seleziono i flat
-    print_list(flat, 'tmp_flats' , main_dir = main_dir)                         #creo lista per IRAF
-    flat = hsel('@'+main_dir+'tmp_flats', main_dir = main_dir, debug = debug)
-    os.remove(main_dir+'tmp_flats')
+        '''
+        Creazione dei masterflat.
 
-    for filtro in filtri:
-        flat_dir = main_dir+filtro+'/flats/'                                #path cartella flat
-        if os.listdir(flat_dir) == []:                                      #controlla che la cartella non sia vuota
-            break 
-        print '### Filtro %s' % filtro
-        print '### Correzione per Bias'
-        flat_list = separa(flat,'filter',filtro, debug = debug)
-        print_list(flat_list, 'flats' , main_dir = flat_dir)                #creo lista per IRAF
-        flat_list_filter = hsel('@'+flat_dir+'flats', main_dir = flat_dir, debug = debug)
-        trim(flat_list_filter['name'], flat_dir, section = trim_section, debug = debug)
+        Per ogni filtro seleziono i flat dalla tabella delle osservazioni.
+        Correggo ogni immagine per bias, linearizzo e normalizzo,
+        un processo per immagine indipendentemente dal filtro.
+        Bias e flat stanno in cartelle diverse.
+        '''
 
-        for image in flat_list_filter['name']:                                      #sottraggo bias
-            op1 = flat_dir+image+'.tr'                                      
-            out = flat_dir+image+'.b'
-            print '%s - %smbias %s' %(op1,bias_dir,out)
-            operation(op1, bias_dir+'mbias', '-', out, debug = debug)
-            out_l = flat_dir+image+'.l'
-            linearize(out, out_l, debug = debug)                            #linearizzo i flat
+        fase = TRACCIA.fase('flat')
+        filtri_flat = []
+        lib_flat = {}
+        for filtro in filtri:
+            if lib is not None:
+                trovato = lib.cerca('flat', data, binning, trim_section, validita, filtro = filtro, co = [co1, co2, co3])
+                if trovato is not None:
+                    lib_flat[filtro] = trovato
+            if filtro not in lib_flat and len(obs_list.group_by(type = 'Flat', filter = filtro)) == 0 \
+                    and not os.path.exists(main_dir+filtro+'/flats/mflat%s.fits' %(filtro)):
+                continue                                                        #nessun flat per questo filtro
+            filtri_flat.append(filtro)
+
+        da_fare = []
+        input_flat = {}
+        for filtro in filtri_flat:
+            flat_dir = main_dir+filtro+'/flats/'
+            mflat = flat_dir+'mflat%s.fits' %(filtro)
+            input_flat[filtro] = [flat_dir+item for item in obs_list.group_by(type = 'Flat', filter = filtro)]+[mbias]
+            if serve_master(mflat, input_flat[filtro], lib_flat.get(filtro), prodotti, parametri):
+                da_fare.append(filtro)
+
+        task = []
+        for filtro in da_fare:
+            for image in obs_list.group_by(type = 'Flat', filter = filtro):
+                task.append((image, main_dir+filtro+'/flats/', mbias, trim_section, co1, co2, co3))
+
+        print '### Correzione per Bias e Normalizzazione'
+        riduci_tutti(riduci_flat, task, workers, trim_section, memoria_io, normalizza = engine != 'numpy', engine = engine, \
+                salva_trim = salva_trim, lincor = lincor, formato = formato, debug = debug)
 
         '''
-        Normalizzazione dei flat e combinazione per ottenere il masterflat
+        Combinazione per ottenere il masterflat, un processo per filtro.
+        Con engine = 'numpy' la normalizzazione avviene durante la combinazione,
+        senza scrivere i *.n.
         '''
 
-        print '### Normalizzazione'
-
-        flat_stats = stats(flat_list_filter['name'], '.l', flat_dir, debug = debug)                #mi calcolo la mediana per ogni flat
-        for i in range(len(flat_list_filter)):                              #normalizzo i flat dividendo ciascuno per la sua mediana.
-            op1 = flat_dir+flat_list_filter['name'][i]+'.l'
-            out = flat_dir+flat_list_filter['name'][i]+'.n'
-            print '%s / %i %s' %(op1,flat_stats[i],out)
-            operation(op1, flat_stats[i], '/', out, debug = debug)
-                                                                                    
-        os.remove(flat_dir+'flats')                                                    #elimino il file
-
-        combine(flat_list_filter['name'], '.n', 'mflat%s' %(filtro), flat_dir, debug = debug)       #combino tutti i flat nella cartella
-        iraf.display(flat_dir+'mflat%s' %(filtro),frame = 1)
+        if engine == 'numpy':
+            extension, scale = '.l', 'median'
+        else:
+            extension, scale = '.n', None
+        parallelo(combine, [(obs_list.group_by(type = 'Flat', filter = filtro), extension, 'mflat%s' %(filtro), \
+                main_dir+filtro+'/flats/') for filtro in da_fare], workers, engine = engine, scale = scale, debug = debug, **combinazione)       #combino tutti i flat nella cartella
+        for filtro in da_fare:
+            mflat = main_dir+filtro+'/flats/mflat%s.fits' %(filtro)
+            if display:
+                TRACCIA.conta_iraf()
+                iraf.display(mflat,frame = 1)
+            if galleria is not None:
+                galleria.aggiungi(mflat, 'mflat%s' % filtro)
+            prodotti.registra(mflat, input_flat[filtro], parametri)
+            pulisci(main_dir+filtro+'/flats/', obs_list.group_by(type = 'Flat', filter = filtro), conserva)
+            if lib is not None:
+                lib.pubblica(mflat, 'flat', data, binning, trim_section, filtro = filtro, co = [co1, co2, co3])
+        prodotti.salva()
+        fase.chiudi()
         print '################################################'
 
 
-    print '############ Calibrazione oggetti ###############'
-
-    '''
-    Gli oggetti vengono ridotti in modalità standard.
-    Prima vengono trimmati e corretti per bias.
-    Tutte le immagini vengono poi linearizzate.
-    Se ci sono i dark disponibili le immagini vengono corrette per dark
-    e poi per flat.
-    '''
-
-    objects_list = separa(obs_list,'type','Object')                            #seleziono oggetti
-    print_list(objects_list, 'tmp_obj' , main_dir = main_dir)                        #creo lista per IRAF
-    objects_list = hsel('@'+main_dir+'tmp_obj', main_dir = main_dir, debug = debug)
-    os.remove(main_dir+'tmp_obj')
-
-    for filtro in filtri:
-        flat_dir = main_dir+filtro+'/flats/'                                #per ogni filtro definisco la variabile con la cartella
-        obj_dir = main_dir+filtro+'/objects/'                               #per ogni filtro definisco la variabile con la cartella
-        if os.listdir(flat_dir) == []:
-            break 
-        obj_list = separa(objects_list,'filter',filtro)                         #seleziono solo i target con quel filtro
-        print_list(obj_list, 'obj' , main_dir = obj_dir)                    #creo lista per IRAF
-        obj_list_filter = hsel('@'+obj_dir+'obj', main_dir = obj_dir, debug = debug)
-        trim(obj_list_filter['name'], obj_dir, section = trim_section)
-
-        print '### Correzione Bias'
-        for image in obj_list_filter['name']:
-            op1 = obj_dir+image+'.tr'
-            out = obj_dir+image+'.b'
-            print '%s - %smbias %s' %(op1,bias_dir,out)
-            operation(op1, bias_dir+'mbias', '-', out)                               # Correzione per Bias
-            out_l = obj_dir+image+'.l'
-            linearize(out, out_l, debug = debug)                            # linearizzo immagini scientifiche
-
-        print '###Correzione Flat (& Dark)'
-     
-        for i in range(len(obj_list_filter['name'])):
-            image = obj_list_filter['name'][i]
-            if obj_list_filter['texp'][i] in exptime:
-                op1 = obj_dir+image+'.l'
-                out = obj_dir+image+'.d'                                
-                print '%s - %sdark%s %s' %(op1,dark_dir,time, out)
-                operation(op1, dark_dir+'dark%s' %(time), '-', out)              # Correzione per dark
-                out2 = obj_dir+image+'.f'                               
-                mflat = flat_dir+'mflat%s' %(filtro)
-                print '%s / %s %s' %(out, mflat, out2)
-                operation(out, mflat, '/', out2)                        # Correggo per flat
-            else:
-                op1 = obj_dir+image+'.l'
-                out = obj_dir+image+'.f'                                
-                mflat = flat_dir+'mflat%s' %(filtro)
-                print '%s / %s %s' %(op1, mflat, out)
-                operation(op1, mflat, '/', out)                        # Correggo per flat
-        os.system('mkdir '+obj_dir+'final')
-        os.system('mv '+obj_dir+'*.f.fits '+obj_dir+'final')
-        print'###########################################'
-
-if __name__ == '__main__':
-
-    ################# Setting parameters################
-    debug = False
-
-    main_dir='./'               #definisco cartella principale
-
-    trim_section = '[100:3996,100:3996]'                                    #decido la dimensione per il trimming
-
-#    os.system('ds9&') 
-    aa = pipeline(main_dir, trim_section, co1 = 1, co2 = -0.10140076, co3 = 0.034650755, debug = debug)
-
-
-
-
-
-
-
+        print '############ Calibrazione oggetti ###############'
 
+        '''
+        Gli oggetti vengono ridotti in modalità standard.
+        Prima vengono trimmati e corretti per bias.
+        Tutte le immagini vengono poi linearizzate.
+        Se ci sono i dark disponibili le immagini vengono corrette per dark
+        e poi per flat. Ogni immagine è un processo separato, i master
+        sono già tutti pronti. Il dark di ogni tempo di esposizione viene
+        scelto una volta sola con INDICE_DARK: il master con lo stesso tempo
+        (entro tolleranza_dark) o un master scalato. Vengono calibrate solo le immagini il cui
+        file finale manca o è vecchio; con cubo, se il cubo manca o è
+        vecchio, le immagini del filtro che non sono già nel cubo con gli
+        stessi input (vedi CONTIENE).
+        '''
 
+        fase = TRACCIA.fase('oggetti')
+        task = []
+        finali = []                                                             #(finale, input, parametri, cartella, immagini)
+        firme = {}                                                              #(cartella, immagine) -> (input, parametri)
+        cubi = {}
+        generazioni = {}                                                        #cartella -> generazione del cubo
+        indice_dark = IndiceDark(dict((t, dark_dir+'dark%s.fits' % str(t)) for t in exptime \
+                if os.path.exists(dark_dir+'dark%s.fits' % str(t))), tolleranza = tolleranza_dark, scala = scala_dark)
+        dark_texp = {}
+        parametri_finali = dict(parametri, formato_finale = formato_finale)
+        parametri_cubo = dict(parametri_finali, tolleranza_dark = tolleranza_dark, scala_dark = scala_dark)
+        for filtro in filtri_flat:
+            flat_dir = main_dir+filtro+'/flats/'                                #per ogni filtro definisco la variabile con la cartella
+            obj_dir = main_dir+filtro+'/objects/'                               #per ogni filtro definisco la variabile con la cartella
+            obj_list_filter = obs_list.seleziona(type = 'Object', filter = filtro)  #seleziono solo i target con quel filtro
+            if not os.path.isdir(obj_dir+'final'):
+                os.makedirs(obj_dir+'final')
+
+            task_cubo = []
+            input_cubo = []
+            for i in range(len(obj_list_filter)):
+                image = obj_list_filter['name'][i]
+                texp = float(obj_list_filter['texp'][i])
+                if texp not in dark_texp:                                       #una volta per tempo di esposizione
+                    dark_texp[texp] = scegli_dark(indice_dark, texp, dark_dir, prodotti, parametri, engine)
+                mdark, scelta = dark_texp[texp]
+                mflat = flat_dir+'mflat%s.fits' %(filtro)
+                input_obj = [obj_dir+image, mbias, mflat]
+                if mdark is not None:
+                    input_obj.append(mdark[0] if isinstance(mdark, list) else mdark)
+                parametri_obj = dict(parametri_finali, dark = scelta)              #master e fattore di scala del dark
+                firme[(obj_dir, image)] = (input_obj, parametri_obj)
+                if cubo:
+                    task_cubo.append((image, obj_dir, mbias, mdark, mflat, trim_section, co1, co2, co3))
+                    input_cubo.extend(item for item in input_obj if item not in input_cubo)
+                    continue
+                if prodotti.aggiornato(obj_dir+'final/'+image+'.f.fits', input_obj, parametri_obj):
+                    continue
+                task.append((image, obj_dir, mbias, mdark, mflat, trim_section, co1, co2, co3))
+                finali.append((obj_dir+'final/'+image+'.f.fits', input_obj, parametri_obj, obj_dir, [image]))
+
+            nome_cubo = obj_dir+'final/cubo%s.fits' % filtro
+            if len(task_cubo) and not prodotti.aggiornato(nome_cubo, input_cubo, parametri_cubo):
+                header = fits.getheader(nome_fits(obj_dir+task_cubo[0][0]))
+                sy, sx = sezione(trim_section)
+                forma = (len(range(*sy.indices(header['NAXIS2']))), len(range(*sx.indices(header['NAXIS1']))))
+                copia = []
+                if os.path.exists(nome_cubo):                                   #piani ancora buoni del cubo vecchio
+                    vecchi = indice_cubo(nome_cubo)[0]
+                    copia = [item[0] for item in task_cubo if item[0] in vecchi and \
+                            prodotti.contiene(nome_cubo, firme[(obj_dir, item[0])][0], parametri_cubo)]
+                generazioni[obj_dir] = crea_cubo(nome_cubo, forma, obj_list_filter, \
+                        fits.Header([('FILTER', filtro), ('TRIMSEC', trim_section)]), copia = copia)
+                cubi[obj_dir] = nome_cubo
+                nuovi = [item for item in task_cubo if item[0] not in copia]
+                if copia:
+                    print '### %s: %i piani copiati, %i da calibrare' % (nome_cubo, len(copia), len(nuovi))
+                if not nuovi:                                                   #es. tolta un'immagine
+                    prodotti.registra(nome_cubo, input_cubo, parametri_cubo)
+                    continue
+                task.extend(nuovi)
+                finali.append((nome_cubo, input_cubo, parametri_cubo, obj_dir, [item[0] for item in nuovi]))
+
+        in_attesa = np.sum(~np.in1d(obs_list.seleziona(type = 'Object')['filter'], filtri_flat))
+        if in_attesa:
+            print '### %i immagini in attesa del masterflat' % in_attesa
+        prodotti.salva()                                                        #cubi registrati senza task, anche per la coda
+        if coda is not None:
+            '''
+            L'id di ogni task contiene le impronte dei suoi input: se un input
+            cambia sotto lo stesso nome il task è nuovo. Un task già fatto il
+            cui finale è stato poi riscritto (es. da un'altra generazione)
+            viene rifatto. I task di un cubo contengono la sua generazione:
+            un cubo ricreato ha tutti task nuovi. I task falliti (anche la
+            registrazione, fallita per dipendenza) vengono rimessi in coda.
+            '''
+            c = Coda(coda)
+            kwargs = dict(engine = engine, salva_trim = salva_trim, lincor = lincor, formato = formato_finale, \
+                    conserva = conserva, anteprime = dir_anteprime, cubi = cubi)
+            ids = {}
+            for item in task:
+                image, obj_dir = item[0], item[1]
+                input_obj, parametri_obj = firme[(obj_dir, image)]
+                impronte = {'input': dict((os.path.abspath(nome_fits(f)), prodotti.impronta(f)) for f in input_obj), \
+                        'parametri': parametri_obj}
+                kwargs_task = dict(kwargs, generazione = generazioni[obj_dir]) if obj_dir in cubi else kwargs
+                id = c.id(image, 'riduci_finale', item, kwargs_task, impronte)
+                finale = obj_dir+'final/'+image+'.f.fits'
+                stato = c.stato(id)
+                rifai = stato == 'falliti' or (obj_dir not in cubi and stato == 'fatti' and \
+                        (not os.path.exists(finale) or c.risultato(id) != timbro(finale)))
+                ids[(obj_dir, image)] = c.aggiungi(image, 'riduci_finale', item, kwargs_task, rifai = rifai, impronte = impronte)
+            notte = os.path.basename(os.path.abspath(main_dir))
+            args = [prodotti.stato_file, [[finale, input_obj, parametri_obj, [ids[(obj_dir, image)] for image in immagini]] \
+                    for finale, input_obj, parametri_obj, obj_dir, immagini in finali]]
+            kwargs = dict(anteprime = dir_anteprime, coda_dir = c.coda_dir)
+            c.aggiungi(notte+'_registra', 'registra_finali', args, kwargs, dipende = [ids[(item[1], item[0])] for item in task], \
+                    rifai = c.stato(c.id(notte+'_registra', 'registra_finali', args, kwargs)) == 'falliti')
+            print '### Correzione Bias, Flat (& Dark): %i immagini in coda %s' % (len(task), c.coda_dir)
+            fase.chiudi()
+            if galleria is not None:
+                galleria.chiudi()
+            fine_traccia(chrome)
+            return 'in coda'
+        print '### Correzione Bias, Flat (& Dark): %i immagini' % len(task)
+        fatti = set()
+        passo = 8*max(1, workers)                                               #finali registrati a blocchi: dopo un crash
+        for inizio in range(0, len(task), passo):                               #non si rifanno i blocchi già finiti
+            blocco = task[inizio:inizio+passo]
+            riduci_tutti(riduci_oggetto, blocco, workers, trim_section, memoria_io, engine = engine, salva_trim = salva_trim, \
+                    lincor = lincor, formato = formato_finale, anteprime = dir_anteprime, cubi = cubi, debug = debug)
+            fatti.update((item[1], item[0]) for item in blocco)
+            rimasti = []
+            for finale, input_obj, parametri_obj, obj_dir, immagini in finali:
+                if not all((obj_dir, image) in fatti for image in immagini):   #un cubo è finito con la sua ultima immagine
+                    rimasti.append((finale, input_obj, parametri_obj, obj_dir, immagini))
+                    continue
+                if obj_dir not in cubi:
+                    os.rename(obj_dir+immagini[0]+'.f.fits', finale)
+                prodotti.registra(finale, input_obj, parametri_obj)
+                pulisci(obj_dir, immagini, conserva)
+            finali = rimasti
+            prodotti.salva()
+        fase.chiudi()
+        if galleria is not None:
+            galleria.chiudi()
+            print 'Anteprime: %sindex.html' % dir_anteprime
+        print'###########################################'
+        fine_traccia(chrome)
+        return 'ok'
+    except:
+        TRACCIA.chiudi(errore = True)                                       #chiude le fasi aperte
+        raise
 
+'''
+Dark per il tempo di esposizione texp (vedi DARK).
+Con IRAF il dark scalato viene scritto una volta, come dark<texp>.s.fits.
+Output:
+    - mdark per RIDUCI_OGGETTO: None, il nome del master o [master, scala]
+      per un dark scalato
+    - scelta = [master, scala], o None senza dark, per i parametri dei
+      finali: cambiando tolleranza o scala dei dark cambia la scelta, e i
+      finali vanno rifatti
+'''
+def scegli_dark(indice_dark, texp, dark_dir, prodotti, parametri, engine):
+    mdark, scala = indice_dark.cerca(texp)
+    if mdark is None:
+        return None, None
+    scelta = [mdark, scala]
+    if scala == 1.:
+        return mdark, scelta
+    print '### Dark per %ss: %s x %.4g' % (texp, mdark, scala)
+    if engine == 'numpy':
+        return [mdark, scala], scelta
+    out = dark_dir+'dark%s.s.fits' % str(texp)
+    parametri = dict(parametri, scala = scala)
+    if not prodotti.aggiornato(out, [mdark], parametri):
+        operation(mdark, scala, '*', out, engine = engine)
+        prodotti.registra(out, [mdark], parametri)
+        prodotti.salva()                                                    #non va riscritto mentre i task lo leggono
+    return out, scelta
 
+'''
+Chiude la traccia di PIPELINE: stampa il riepilogo per fase ed esporta la
+traccia per chrome://tracing se richiesto.
+'''
+def fine_traccia(chrome = None):
+    if TRACCIA.file is None:
+        return
+    print '############ Tempi ###############'
+    TRACCIA.riepilogo()
+    if chrome is not None:
+        TRACCIA.chrome(chrome)
+        print 'Traccia per chrome://tracing: %s' % chrome
+    TRACCIA.chiudi()
+
+############################ SORVEGLIA ####################################
 
+'''
+Modalità streaming: sorveglia la cartella di acquisizione e riduce i frame
+man mano che arrivano durante la notte.
+Ogni intervallo secondi controlla i file *.fits della cartella; un file è
+pronto quando la sua dimensione e il suo mtime non cambiano tra due controlli
+(la scrittura è finita). Quando ci sono file nuovi pronti rilancia PIPELINE,
+non interattiva e senza DS9, sui soli file pronti. Dato che la pipeline
+ricostruisce solo i prodotti vecchi o mancanti (vedi PRODOTTI):
+    - i nuovi bias/dark/flat fanno ricostruire solo i master interessati
+    - le immagini scientifiche vengono calibrate appena ci sono i loro master;
+      fino ad allora restano in coda e vengono calibrate a un giro successivo.
+Un file pronto il cui header non si legge, o con i dati più corti di
+quanto dice l'header (es. lettura del CCD interrotta), viene messo da parte
+(vedi CONTROLLA_FRAME) e non blocca gli altri; viene riconsiderato se il
+file cambia. Se un giro fallisce per altri motivi l'errore viene stampato
+e il giro viene ritentato al controllo successivo.
 
+Input:
+    - main_dir = cartella di acquisizione
+    - trim_section = sezione di trimming
+    - intervallo = secondi tra due controlli, default = 5
+    - durata = secondi dopo i quali fermarsi, default = None (mai)
+    - kwargs = altri parametri per PIPELINE (co1, ..., engine, workers, ...)
+'''
 
+def sorveglia(main_dir, trim_section, intervallo = 5, durata = None, **kwargs):
+    inizio = time.time()
+    visti = {}
+    pronti = set()
+    scartati = set()
+    da_ridurre = False
+    print '############ Sorveglio %s ############' % main_dir
+    while durata is None or time.time()-inizio < durata:
+        for nome in glob.glob(main_dir+'*.fits'):
+            try:
+                st = os.stat(nome)
+            except OSError:                                                 #file sparito nel frattempo
+                continue
+            firma = (st.st_size, st.st_mtime)
+            if visti.get(nome) != firma:
+                scartati.discard(nome)                                      #riscritto, si riprova
+            elif nome not in pronti and nome not in scartati:
+                try:
+                    controlla_frame(nome)
+                    pronti.add(nome)
+                    da_ridurre = True
+                except IOError as e:
+                    print '### Frame scartato: %s' % e
+                    scartati.add(nome)
+            visti[nome] = firma
+        if da_ridurre:
+            print '### %s: %i frame pronti' % (time.strftime('%H:%M:%S'), len(pronti))
+            try:
+                pipeline(main_dir, trim_section, files = sorted(pronti), interattivo = False, display = False, **kwargs)
+                da_ridurre = False
+            except Exception as e:
+                print '### Errore, riprovo al prossimo controllo: %s' % e
+        time.sleep(intervallo)
 
+'''
+Controlla che un frame sia leggibile per intero: header completo (vedi
+LEGGI_HEADER) e file lungo almeno quanto l'header più i dati che descrive.
+Solleva IOError altrimenti.
+'''
+def controlla_frame(nome):
+    header = leggi_header(nome)
+    f = open(nome, 'rb')
+    try:
+        fits.Header.fromfile(f)
+        inizio = f.tell()                                                   #i dati iniziano dopo l'header
+    finally:
+        f.close()
+    nbyte = 0
+    if header.get('NAXIS', 0):
+        nbyte = abs(header.get('BITPIX', 8))//8
+        for i in range(1, header['NAXIS']+1):
+            nbyte *= header.get('NAXIS%i' % i, 0)
+    if os.path.getsize(nome) < inizio+nbyte:
+        raise IOError('%s: dati FITS incompleti' % nome)
 
+############################## LOTTO ######################################
 
+'''
+Riduzione non interattiva di molte notti, per rifare intere campagne.
+Ogni notte viene ridotta da PIPELINE (interattivo = False, display = False).
+Mentre una notte è in calibrazione (CPU) un processo separato prepara le
+notti successive, la parte dominata dall'I/O:
+    - legge gli header e aggiorna il catalogo (vedi CATALOGO)
+    - organizza i file nelle cartelle (vedi ORGANIZZA)
+    - legge i frame grezzi per portarli nella cache del sistema operativo,
+      fino a precarica MB per notte
+Quando tocca a quella notte PIPELINE trova catalogo e cartelle già pronti
+e i frame già in memoria. Se una notte fallisce l'errore viene stampato e
+si passa alla successiva; rilanciando, PIPELINE rifà solo quello che manca
+(vedi PRODOTTI).
 
+Input:
+    - notti = lista delle cartelle delle notti
+    - trim_section = sezione di trimming
+    - anticipo = numero di notti preparate in anticipo, 0 per non prepararle,
+      default = 1
+    - precarica = MB di frame grezzi letti in anticipo per ogni notte,
+      default = 1024
+    - traccia, chrome = come in PIPELINE, ma relativi alla cartella di ogni
+      notte, default = None
+    - kwargs = altri parametri per PIPELINE (co1, ..., engine, workers, ...)
+Output:
+    - lista con un dizionario per notte: notte, esito ('ok', 'fallita', o
+      'saltata' se PIPELINE non ha trovato niente da calibrare, es. nessun
+      bias), tempo in secondi ed errore
+'''
+def lotto(notti, trim_section, anticipo = 1, precarica = 1024, traccia = None, chrome = None, **kwargs):
+    notti = [os.path.join(os.path.abspath(item), '') for item in notti]
+    kwargs.update(interattivo = False, display = False)
+    pool = None
+    if anticipo > 0 and len(notti) > 1:
+        pool = multiprocessing.Pool(1)
+    preparate = {}
+    esiti = []
+    try:
+        for i, main_dir in enumerate(notti):
+            for j in range(i+1, min(i+anticipo+1, len(notti))):        #le prossime notti, in ordine
+                if pool is not None and j not in preparate:
+                    preparate[j] = pool.apply_async(prepara_notte, (notti[j], kwargs.get('organizzazione', 'hardlink'), precarica))
+            if i in preparate:
+                try:
+                    preparate.pop(i).get()
+                except Exception as e:                                  #ci riprova PIPELINE
+                    print '### %s: preparazione fallita: %s' % (main_dir, e)
+
+            print '############ Notte %i/%i: %s ############' % (i+1, len(notti), main_dir)
+            inizio = time.time()
+            esito = dict(notte = main_dir, esito = 'ok', errore = None)
+            try:
+                risultato = pipeline(main_dir, trim_section, traccia = None if traccia is None else os.path.join(main_dir, traccia), \
+                        chrome = None if chrome is None else os.path.join(main_dir, chrome), **kwargs)
+                if risultato not in ('ok', 'in coda'):
+                    esito.update(esito = 'saltata', errore = risultato)
+            except Exception as e:                                          #la traccia l'ha chiusa PIPELINE
+                traceback.print_exc()
+                esito.update(esito = 'fallita', errore = '%s: %s' % (type(e).__name__, e))
+            esito['tempo'] = time.time()-inizio
+            esiti.append(esito)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return esiti
 
+'''
+Parte di I/O della riduzione di una notte, per LOTTO: catalogo, ORGANIZZA
+e lettura dei primi precarica MB dei frame grezzi (i dati letti vengono
+buttati, restano nella cache del sistema operativo).
+'''
+def prepara_notte(main_dir, organizzazione = 'hardlink', precarica = 1024):
+    obs_list = Tabella(hsel(main_dir+'*.fits', main_dir = main_dir, cache = main_dir+'catalogo_header.json'))
+    organizza(obs_list, main_dir = main_dir, modo = organizzazione)
+    resto = precarica*1024**2
+    for item in obs_list['name']:
+        if resto <= 0:
+            break
+        f = open(main_dir+item+'.fits', 'rb')
+        while resto > 0:
+            blocco = f.read(min(resto, 16*1024**2))
+            if not blocco:
+                break
+            resto -= len(blocco)
+        f.close()
 
+'''
+Legge il file di configurazione di MAIN: un oggetto JSON con i parametri
+di PIPELINE e di LOTTO, es.
+    {"trim_section": "[100:3996,100:3996]",
+     "co1": 1, "co2": -0.10140076, "co3": 0.034650755,
+     "engine": "numpy", "workers": 8,
+     "combinazione": {"comb": "median", "rej": "minmax", "low": 1, "high": 1}}
+Parametri sconosciuti sono un errore (ValueError), per non ignorare
+in silenzio un nome sbagliato; così come un engine non valido (vedi
+MOTORE), che altrimenti farebbe fallire tutte le notti una per una.
+'''
+def leggi_config(nome):
+    f = open(nome)
+    try:
+        config = json.load(f)
+    finally:
+        f.close()
+    if not isinstance(config, dict):
+        raise ValueError('%s: serve un oggetto JSON' % nome)
+    ammessi = set(inspect.getargspec(pipeline).args+inspect.getargspec(lotto).args) \
+            - set(['main_dir', 'notti', 'files', 'interattivo', 'display'])
+    sconosciuti = sorted(item for item in config if item not in ammessi)
+    if sconosciuti:
+        raise ValueError('%s: parametri sconosciuti %s' % (nome, ', '.join(sconosciuti)))
+    if 'engine' in config:
+        motore(config['engine'])
+    return config
 
+'''
+Riga di comando, senza domande, per ridurre una o più notti:
+    python reduction_1.0.py /dati/2017011[0-9]/ --config schmidt.json
+    python reduction_1.0.py '/dati/2017*/' -c schmidt.json --workers 8 --rapporto esiti.json
+    python reduction_1.0.py '/dati/2017*/' -c schmidt.json --coda /shared/coda/
+    python reduction_1.0.py --lavora /shared/coda/ [--durata 1800] [--resta]
+Le cartelle possono contenere wildcard (espanse qui se la shell non lo fa).
+Le opzioni della riga di comando hanno la precedenza sul file di
+configurazione (vedi LEGGI_CONFIG). Con --coda le notti vengono messe
+nella CODA (vedi DISTRIBUISCI) invece di essere ridotte qui; con --lavora
+il nodo esegue i task della coda (vedi LAVORA) finché la coda è vuota, o
+sempre con --resta.
+
+Exit code:
+    0 = tutte le notti ridotte (o messe in coda)
+    1 = almeno una notte fallita o saltata (es. senza bias), le altre sono
+        state ridotte
+    2 = errore negli argomenti o nella configurazione, nessuna notte ridotta
+'''
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Riduzione non interattiva delle notti della Schmidt')
+    parser.add_argument('notti', nargs = '*', help = 'cartelle delle notti, anche con wildcard')
+    parser.add_argument('-c', '--config', default = None, help = 'file JSON con i parametri della pipeline')
+    parser.add_argument('--trim-section', default = None, help = 'default = [100:3996,100:3996]')
+    parser.add_argument('--engine', choices = ('iraf', 'numpy'), default = None)
+    parser.add_argument('--workers', type = int, default = None)
+    parser.add_argument('--anticipo', type = int, default = None, help = 'notti preparate in anticipo, default = 1')
+    parser.add_argument('--precarica', type = int, default = None, help = 'MB di frame letti in anticipo per notte, default = 1024')
+    parser.add_argument('--coda', default = None, help = 'mette le notti in questa coda invece di ridurle')
+    parser.add_argument('--rapporto', default = None, help = 'file JSON con l\'esito di ogni notte')
+    parser.add_argument('--lavora', default = None, metavar = 'CODA', help = 'esegue i task di questa coda')
+    parser.add_argument('--durata', type = int, default = 1800, help = 'durata della lease in secondi, con --lavora')
+    parser.add_argument('--resta', action = 'store_true', help = 'con --lavora aspetta nuovi task a coda vuota')
+    parser.add_argument('--debug', action = 'store_true')
+    args = parser.parse_args(argv)
+    if args.lavora is not None:
+        if args.notti:
+            parser.error('--lavora non riduce notti')
+        eseguiti = lavora(args.lavora, durata = args.durata, esci = not args.resta)
+        print '%i task eseguiti dalla coda %s' % (eseguiti, args.lavora)
+        return 0
+    if not args.notti:
+        parser.error('servono le cartelle delle notti, o --lavora')
+
+    try:
+        config = leggi_config(args.config) if args.config is not None else {}
+    except (IOError, ValueError) as e:
+        print >>sys.stderr, 'Configurazione non valida: %s' % e
+        return 2
+    for item in ('trim_section', 'engine', 'workers', 'anticipo', 'precarica'):
+        if getattr(args, item) is not None:
+            config[item] = getattr(args, item)
+    if args.debug:
+        config['debug'] = True
+    trim_section = config.pop('trim_section', '[100:3996,100:3996]')
+
+    notti = []
+    for item in args.notti:
+        trovate = sorted(glob.glob(item)) if glob.has_magic(item) else [item]
+        trovate = [nome for nome in trovate if os.path.isdir(nome)]
+        if not trovate:
+            print >>sys.stderr, 'Nessuna notte in %s' % item
+            return 2
+        notti.extend(nome for nome in trovate if nome not in notti)
+
+    if args.coda is not None:
+        for item in ('anticipo', 'precarica', 'traccia', 'chrome'):            #solo per LOTTO
+            config.pop(item, None)
+        ids = distribuisci(args.coda, notti, trim_section, **config)
+        print '%i notti in coda %s' % (len(ids), args.coda)
+        return 0
+
+    esiti = lotto(notti, trim_section, **config)
+    print '############ Esiti ############'
+    for item in esiti:
+        print '%-8s %8.1f s  %s%s' % (item['esito'], item['tempo'], item['notte'], \
+                '' if item['errore'] is None else '  ('+item['errore']+')')
+    if args.rapporto is not None:
+        scrivi_json(args.rapporto, esiti)
+    falliti = len([item for item in esiti if item['esito'] != 'ok'])
+    if falliti:
+        print '%i notti su %i fallite o saltate' % (falliti, len(esiti))
+        return 1
+    return 0
 
+if __name__ == '__main__':
+    sys.exit(main())